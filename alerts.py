@@ -0,0 +1,105 @@
+import csv
+import weakref
+from bisect import bisect_left, insort
+
+THRESHOLDS_FILENAME = "stock_thresholds.csv"
+
+# Reorder threshold for items without one of their own
+DEFAULT_REORDER_THRESHOLD = 5
+
+# Items this many units above their threshold are listed as running low
+NEAR_THRESHOLD_MARGIN = 5
+
+
+# Helper function for reading reorder thresholds; an empty size applies to every size of the item
+def read_thresholds(filename):
+    thresholds = {}
+    try:
+        with open(filename, mode='r', newline='') as file:
+            for row in csv.DictReader(file):
+                thresholds[(row['name'], row['size'])] = int(row['threshold'])
+    except FileNotFoundError:
+        pass
+    return thresholds
+
+
+# Helper function for writing reorder thresholds
+def write_thresholds(filename, thresholds):
+    from storage import atomic_write
+    with atomic_write(filename) as file:
+        writer = csv.writer(file)
+        writer.writerow(['name', 'size', 'threshold'])
+        writer.writerows([name, size, threshold] for (name, size), threshold in thresholds.items())
+
+
+class LowStockAlerts:
+    """Sorted index of the items at or near their reorder threshold, updated as each record changes."""
+
+    def __init__(self, store, thresholds=None, default_threshold=DEFAULT_REORDER_THRESHOLD,
+                 near_margin=NEAR_THRESHOLD_MARGIN):
+        """Index the store's records once; later changes update the index one record at a time."""
+        # A proxy, so the engine kept alongside a store does not keep the store alive
+        self.store = weakref.proxy(store)
+        self.thresholds = {} if thresholds is None else thresholds
+        self.default_threshold = default_threshold
+        self.near_margin = near_margin
+        self._entries = []  # sorted (quantity - threshold, name, size) for items within near_margin
+        self._margins = {}  # (name, size) -> margin of its entry in _entries
+        for record in store:
+            self.update(record)
+
+    def threshold_for(self, name, size):
+        """Return the reorder threshold of an item size."""
+        threshold = self.thresholds.get((name, size))
+        if threshold is None:
+            threshold = self.thresholds.get((name, ""), self.default_threshold)
+        return threshold
+
+    def update(self, record):
+        """Re-index one record after its quantity or threshold changed."""
+        self.remove(record)
+        margin = record.quantity - self.threshold_for(record.name, record.size)
+        if margin <= self.near_margin:
+            insort(self._entries, (margin, record.name, record.size))
+            self._margins[(record.name, record.size)] = margin
+
+    def remove(self, record):
+        """Drop a removed record from the index."""
+        margin = self._margins.pop((record.name, record.size), None)
+        if margin is not None:
+            del self._entries[bisect_left(self._entries, (margin, record.name, record.size))]
+
+    def set_threshold(self, name, size, threshold):
+        """Set the threshold of one size, or of every size of the item when size is empty."""
+        self.thresholds[(name, size)] = threshold
+        for item_size in ([size] if size else self.store.sizes(name)):
+            record = self.store.get(name, item_size)
+            if record is not None:
+                self.update(record)
+
+    def is_low(self, name, size):
+        """Check if an item size is at or below its reorder threshold."""
+        margin = self._margins.get((name, size))
+        return margin is not None and margin <= 0
+
+    def entries(self):
+        """Return (name, size, quantity, threshold, needs_reorder) for indexed items, lowest margin first."""
+        result = []
+        for margin, name, size in self._entries:
+            threshold = self.threshold_for(name, size)
+            result.append((name, size, margin + threshold, threshold, margin <= 0))
+        return result
+
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def alerts_for(store, thresholds_filename=THRESHOLDS_FILENAME):
+    """Return the alert engine for a stock store, building it on first use and keeping it current."""
+    engine = _engines.get(store)
+    if engine is None:
+        engine = LowStockAlerts(store, read_thresholds(thresholds_filename))
+        store.subscribe(lambda op, record: engine.remove(record) if op == "remove" else engine.update(record),
+                        remote=True)
+        _engines[store] = engine
+    return engine
@@ -0,0 +1,129 @@
+import weakref
+from array import array
+
+# NumPy is optional: the reports use it for the column arithmetic when it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class StockColumns:
+    """Column-oriented copy of the stock table: one array per field, names and sizes as integer codes.
+
+    Each (name, size) has one row; a removed item's row is filled by moving the last row into it.
+    Codes are never reused, so name_rows and size_rows count the rows that still use each one.
+    """
+
+    def __init__(self, store):
+        """Build the columns from a stock store in one pass; later changes update one row at a time."""
+        self.names = []
+        self.sizes = []
+        self.name_rows = []
+        self.size_rows = []
+        self._name_codes = {}
+        self._size_codes = {}
+        self._rows = {}  # (name, size) -> row number
+        self.name_code = array('q')
+        self.size_code = array('q')
+        self.quantity = array('q')
+        self.price_cents = array('q')
+        for record in store:
+            self.update(record)
+
+    def __len__(self):
+        return len(self.quantity)
+
+    @staticmethod
+    def _code(value, codes, values, rows):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+            rows.append(0)
+        rows[code] += 1
+        return code
+
+    def update(self, record):
+        """Copy the quantity and price of a new or changed record into its row."""
+        row = self._rows.get((record.name, record.size))
+        if row is None:
+            self._rows[(record.name, record.size)] = len(self.quantity)
+            self.name_code.append(self._code(record.name, self._name_codes, self.names, self.name_rows))
+            self.size_code.append(self._code(record.size, self._size_codes, self.sizes, self.size_rows))
+            self.quantity.append(record.quantity)
+            self.price_cents.append(record.price_cents)
+        else:
+            self.quantity[row] = record.quantity
+            self.price_cents[row] = record.price_cents
+
+    def remove(self, record):
+        """Drop the row of a removed record."""
+        row = self._rows.pop((record.name, record.size), None)
+        if row is None:
+            return
+        self.name_rows[self.name_code[row]] -= 1
+        self.size_rows[self.size_code[row]] -= 1
+        last = len(self.quantity) - 1
+        if row != last:
+            for column in (self.name_code, self.size_code, self.quantity, self.price_cents):
+                column[row] = column[last]
+            self._rows[(self.names[self.name_code[row]], self.sizes[self.size_code[row]])] = row
+        for column in (self.name_code, self.size_code, self.quantity, self.price_cents):
+            column.pop()
+
+
+_columns = weakref.WeakKeyDictionary()
+
+
+def columns_for(store):
+    """Return the columns of a stock store, building them on first use and keeping them current."""
+    columns = _columns.get(store)
+    if columns is None:
+        columns = StockColumns(store)
+        store.subscribe(lambda op, record: columns.remove(record) if op == "remove" else columns.update(record),
+                        remote=True)
+        _columns[store] = columns
+    return columns
+
+
+def _grouped_totals(codes, group_count, quantity, value):
+    """Sum units and value per group code; returns two lists indexed by code."""
+    if np is not None:
+        codes = np.frombuffer(codes, dtype=np.int64)
+        units = np.bincount(codes, weights=quantity, minlength=group_count)
+        values = np.bincount(codes, weights=value, minlength=group_count)
+        return units.astype(np.int64).tolist(), values.astype(np.int64).tolist()
+    units = [0] * group_count
+    values = [0] * group_count
+    for code, count, amount in zip(codes, quantity, value):
+        units[code] += count
+        values[code] += amount
+    return units, values
+
+
+def inventory_report(store):
+    """Return total units and value, plus units and value per size and per item name.
+
+    Values are in cents. by_size and by_name are lists of (key, units, value_cents), sorted by value
+    from highest to lowest.
+    """
+    columns = columns_for(store)
+    if np is not None:
+        quantity = np.frombuffer(columns.quantity, dtype=np.int64)
+        value = quantity * np.frombuffer(columns.price_cents, dtype=np.int64)
+        total_units, total_value = int(quantity.sum()), int(value.sum())
+    else:
+        quantity = columns.quantity
+        value = [count * cents for count, cents in zip(columns.quantity, columns.price_cents)]
+        total_units, total_value = sum(quantity), sum(value)
+
+    size_units, size_values = _grouped_totals(columns.size_code, len(columns.sizes), quantity, value)
+    name_units, name_values = _grouped_totals(columns.name_code, len(columns.names), quantity, value)
+    # Names and sizes whose every row has been removed keep their codes but are left out
+    by_size = sorted((entry for entry, rows in zip(zip(columns.sizes, size_units, size_values), columns.size_rows)
+                      if rows), key=lambda entry: entry[2], reverse=True)
+    by_name = sorted((entry for entry, rows in zip(zip(columns.names, name_units, name_values), columns.name_rows)
+                      if rows), key=lambda entry: entry[2], reverse=True)
+    return {'rows': len(columns), 'total_units': total_units, 'total_value': total_value,
+            'by_size': by_size, 'by_name': by_name}
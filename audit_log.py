@@ -0,0 +1,194 @@
+import atexit
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime
+
+AUDIT_BASENAME = "stock_audit"
+
+# Start a new audit segment once the current one reaches this size; the oldest segments beyond
+# AUDIT_BACKUP_COUNT are deleted
+AUDIT_MAX_BYTES = 5 * 1024 * 1024
+AUDIT_BACKUP_COUNT = 10
+
+audit_logger = logging.getLogger("stock.audit")
+
+
+def audit(message, operation, name, size, field, old, new, delta=None):
+    """Log a stock change as a text message and as a structured audit record.
+
+    field is "quantity" or "price"; old is None for an item that did not exist before.
+    """
+    if delta is None and new is not None:
+        delta = new - (old or 0)
+    audit_logger.info(message, extra={'audit': {'operation': operation, 'name': name, 'size': size,
+                                                 'field': field, 'old': old, 'new': new, 'delta': delta}})
+
+
+# Helper function for the file names of one numbered audit segment: (records, index)
+def segment_paths(basename, number):
+    return f"{basename}.{number:06d}.jsonl", f"{basename}.{number:06d}.idx"
+
+
+# Helper function for the numbers of the audit segments on disk, oldest first
+def segment_numbers(basename):
+    numbers = []
+    for path in glob.glob(f"{glob.escape(basename)}.*.jsonl"):
+        number = path[len(basename) + 1:-len(".jsonl")]
+        if number.isdigit():
+            numbers.append(int(number))
+    return sorted(numbers)
+
+
+class AuditLogHandler(logging.Handler):
+    """Writes audit records as JSON lines to size-limited segments, each with an index of its items.
+
+    Segments are numbered and never renamed, so an index stays valid for as long as its segment exists.
+    Every index line holds the byte offset of one record and the item it belongs to. Tills, the API server and
+    the command line can all log at once: each record is written and indexed under a lock shared by every process.
+    """
+
+    def __init__(self, basename=AUDIT_BASENAME, max_bytes=AUDIT_MAX_BYTES, backup_count=AUDIT_BACKUP_COUNT):
+        """Continue the newest segment on disk, or start the first one."""
+        super().__init__()
+        self.basename = basename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        numbers = segment_numbers(basename)
+        self.number = numbers[-1] if numbers else 1
+        self.records = self.index = None
+        self.file_lock = None  # Created with the first record, so storage is not imported at startup
+
+    def _open(self):
+        records_path, index_path = segment_paths(self.basename, self.number)
+        self.records = open(records_path, mode='ab', buffering=0)
+        self.index = open(index_path, mode='ab')
+
+    def _rotate(self):
+        """Close the current segment, start the next one and delete the ones past backup_count."""
+        self.close_files()
+        self.number += 1
+        for number in segment_numbers(self.basename)[:-self.backup_count or None]:
+            for path in segment_paths(self.basename, number):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _catch_up(self):
+        """Move on to the newest segment, in case another process has started a new one since."""
+        while os.path.exists(segment_paths(self.basename, self.number + 1)[0]):
+            self.close_files()
+            self.number += 1
+
+    def emit(self, record):
+        change = getattr(record, 'audit', None)
+        if change is None:
+            return  # Only stock changes go to the audit log
+        try:
+            line = json.dumps(dict(change, timestamp=datetime.fromtimestamp(record.created).isoformat()))
+            data = (line + "\n").encode("utf-8")
+            key = json.dumps([change['name'], change['size']])
+            if self.file_lock is None:
+                from storage import FileLock
+                self.file_lock = FileLock(f"{self.basename}.lock")
+            with self.file_lock:
+                self._catch_up()
+                if self.records is None:
+                    self._open()
+                # Other processes append to the segment too, so its end is looked up again for every record
+                offset = os.fstat(self.records.fileno()).st_size
+                if offset and offset + len(data) > self.max_bytes:
+                    self._rotate()
+                    self._open()
+                    offset = 0
+                self.records.write(data)
+                self.index.write(f"{offset}\t{key}\n".encode("utf-8"))
+                self.index.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close_files(self):
+        for file in (self.records, self.index):
+            if file is not None:
+                file.close()
+        self.records = self.index = None
+
+    def close(self):
+        self.acquire()
+        try:
+            self.close_files()
+        finally:
+            self.release()
+        super().close()
+
+
+class AuditLogReader:
+    """Loads the audit records of one item through the segment indexes, without scanning the records."""
+
+    def __init__(self, basename=AUDIT_BASENAME):
+        """Create a reader; indexes are read on first use and then only their new lines."""
+        self.basename = basename
+        self._indexes = {}  # segment number -> (bytes of the index read so far, {(name, size): [offsets]})
+
+    def _offsets(self, number, name, size):
+        read_bytes, offsets = self._indexes.get(number, (0, {}))
+        try:
+            with open(segment_paths(self.basename, number)[1], mode='rb') as file:
+                file.seek(read_bytes)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break  # Still being written
+                    read_bytes += len(line)
+                    offset, key = line.decode("utf-8").split("\t", 1)
+                    offsets.setdefault(tuple(json.loads(key)), []).append(int(offset))
+        except FileNotFoundError:
+            return []
+        self._indexes[number] = (read_bytes, offsets)
+        return offsets.get((name, size), [])
+
+    def item_history(self, name, size):
+        """Return the audit records of an item size, oldest first."""
+        numbers = segment_numbers(self.basename)
+        for number in list(self._indexes):
+            if number not in numbers:
+                del self._indexes[number]  # Deleted by rotation
+
+        history = []
+        for number in numbers:
+            offsets = self._offsets(number, name, size)
+            if not offsets:
+                continue
+            with open(segment_paths(self.basename, number)[0], mode='rb') as file:
+                for offset in offsets:
+                    file.seek(offset)
+                    history.append(json.loads(file.readline()))
+        return history
+
+
+def setup_logging(text_filename='stock_control.log', basename=AUDIT_BASENAME):
+    """Send log records through a queue to a background thread that writes the text and audit logs.
+
+    Returns the queue listener, which is stopped (flushing anything still queued) when the program exits.
+    """
+    text_handler = logging.FileHandler(text_filename, delay=True)
+    text_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, text_handler, AuditLogHandler(basename))
+    # The queue handler only fills in the message; the file handlers add the timestamp and level
+    logging.basicConfig(handlers=[logging.handlers.QueueHandler(log_queue)], level=logging.INFO, format='%(message)s')
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+if __name__ == "__main__":
+    # Print the audit history of one item: python audit_log.py "T-shirt" M
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python audit_log.py <name> <size>")
+    for change in AuditLogReader().item_history(sys.argv[1], sys.argv[2]):
+        print(json.dumps(change))
@@ -0,0 +1,59 @@
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+
+# How often a window checks whether the job it is waiting for has finished, in milliseconds
+POLL_MS = 30
+
+
+class BackgroundJobs:
+    """Runs slow work off the Tk main thread and hands each result back to it by polling with after().
+
+    Every job (loading, saving, searching, matching) runs one at a time on a single thread, in the order they
+    were submitted, so the store, its indexes and its files never see two jobs at once. The Tk thread only
+    reads what the jobs return, never the store itself.
+    """
+
+    def __init__(self):
+        """Create the job thread; it starts with the first job."""
+        self.store_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stock-store")
+        self.waiting = {}  # progress bar -> number of jobs it is shown for
+
+    def submit(self, widget, job, on_done, on_error, progress=None, buttons=()):
+        """Run job() in the background, then call on_done(result) or on_error(exception) on the Tk thread.
+
+        While the job is waited for, progress (a ttk.Progressbar) runs and buttons are disabled. If the widget
+        is destroyed first, the job still finishes but neither callback is called.
+        """
+        future = self.store_thread.submit(job)
+        if progress is not None:
+            if not self.waiting.get(progress):
+                progress.start()
+            self.waiting[progress] = self.waiting.get(progress, 0) + 1
+        for button in buttons:
+            button.config(state=tk.DISABLED)
+
+        def poll():
+            if not future.done():
+                widget.after(POLL_MS, poll)
+                return
+            if not widget.winfo_exists():
+                return
+            if progress is not None:
+                self.waiting[progress] -= 1
+                if not self.waiting[progress]:
+                    del self.waiting[progress]
+                    progress.stop()
+            for button in buttons:
+                button.config(state=tk.NORMAL)
+            error = future.exception()
+            if error is not None:
+                on_error(error)
+            else:
+                on_done(future.result())
+
+        widget.after(POLL_MS, poll)
+        return future
+
+    def shutdown(self):
+        """Finish the jobs already submitted, so no change is left unsaved, and stop the thread."""
+        self.store_thread.shutdown(wait=True)
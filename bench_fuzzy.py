@@ -0,0 +1,96 @@
+import argparse
+import random
+import string
+import time
+
+from fuzzy_match import ENGINES, SimilarNameIndex, get_engine
+
+SYLLABLES = ["re", "me", "ra", "in", "ter", "mia", "mi", "za", "pa", "je", "ans", "so", "ck", "shirt", "nu",
+             "e", "va", "co", "sa", "prue", "ba", "yer", "sey", "new", "to", "ka", "lo", "ni", "bu", "zo"]
+
+
+# Helper function for generating a random item name
+def random_name(rng):
+    words = ["".join(rng.choices(SYLLABLES, k=rng.randint(1, 3))) for _ in range(rng.randint(1, 4))]
+    return " ".join(words).capitalize()
+
+
+# Helper function for introducing a typo into a name
+def misspell(rng, name):
+    position = rng.randrange(len(name))
+    return name[:position] + rng.choice(string.ascii_lowercase) + name[position + 1:]
+
+
+def build_queries(rng, names, count):
+    """Return add_stock names: half are typos of existing names, half are new names."""
+    queries = []
+    for i in range(count):
+        queries.append(misspell(rng, rng.choice(names)) if i % 2 == 0 else random_name(rng))
+    return queries
+
+
+def run(size, query_count, engines, full_scan_limit, seed):
+    """Benchmark every engine on one catalogue size and print latency and agreement.
+
+    Where the full scan runs, also count how often the index suggests the same name as scoring every name.
+    """
+    rng = random.Random(seed)
+    names = [random_name(rng) for _ in range(size)]
+    queries = build_queries(rng, names, query_count)
+    print(f"\n{size:,} names, {query_count} add_stock lookups", flush=True)
+
+    results = {}
+    for engine in engines:
+        start = time.perf_counter()
+        index = SimilarNameIndex(names, engine=engine)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results[engine.name] = [index.find_similar(query, score_cutoff=85) for query in queries]
+        indexed_ms = (time.perf_counter() - start) * 1000 / query_count
+
+        full_scan = "skipped"
+        recall = ""
+        if size <= full_scan_limit:
+            unique_names = list(dict.fromkeys(names))
+            start = time.perf_counter()
+            scanned = [engine.extract_one(query, unique_names, 85) for query in queries]
+            full_scan = f"{(time.perf_counter() - start) * 1000 / query_count:.2f} ms/add"
+            # Ties between equally scored names may be broken differently, so compare scores too
+            same = sum((a and a[0]) == (b and b[0]) or (a and a[1]) == (b and b[1])
+                       for a, b in zip(results[engine.name], scanned))
+            recall = f"   index matches full scan {same}/{query_count}"
+        print(f"  {engine.name:<10} index build {build_time:7.2f} s   indexed {indexed_ms:8.2f} ms/add   "
+              f"full scan {full_scan}{recall}", flush=True)
+
+    # Engines agree when they suggest the same existing name (or none) at score_cutoff=85
+    reference = engines[0].name
+    for engine in engines[1:]:
+        same = sum((a and a[0]) == (b and b[0]) for a, b in zip(results[reference], results[engine.name]))
+        print(f"  {engine.name} vs {reference}: {same}/{query_count} matches agree")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the duplicate-detection fuzzy matching engines.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="catalogue sizes to benchmark")
+    parser.add_argument("--queries", type=int, default=100, help="add_stock lookups per catalogue")
+    parser.add_argument("--full-scan-limit", type=int, default=1000,
+                        help="largest catalogue to also time without the index")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # fuzzywuzzy is the reference when installed, since it is what the app used before
+    engines = []
+    for name in ["fuzzywuzzy"] + [name for name in ENGINES if name != "fuzzywuzzy"]:
+        try:
+            engines.append(get_engine(name))
+        except ImportError:
+            print(f"{name} is not installed, skipping it.")
+
+    for size in args.sizes:
+        run(size, args.queries, engines, args.full_scan_limit, args.seed)
+
+
+if __name__ == "__main__":
+    main()
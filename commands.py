@@ -0,0 +1,182 @@
+import weakref
+from collections import deque
+
+from stock_store import StockError
+
+# Most recent changes that can be undone
+UNDO_LIMIT = 100
+
+
+# Helper function for checking two optional rows hold the same quantity, price and availability
+def same_row(record, other):
+    if record is None or other is None:
+        return record is other
+    return (record.quantity, record.price_cents, record.available) == (other.quantity, other.price_cents,
+                                                                       other.available)
+
+
+class StockCommand:
+    """A change to one item size that remembers the row before and after it, so it can be inverted."""
+
+    def __init__(self, name, size):
+        """Initialize the command for the given item and size."""
+        self.name = name
+        self.size = size
+        self.before = None
+        self.after = None
+
+    def run(self, store):
+        """Make the change and return its result."""
+        raise NotImplementedError
+
+    def describe(self):
+        """Return a short description of the change for the user."""
+        raise NotImplementedError
+
+    def execute(self, store):
+        """Make the change, remembering the row before and after it."""
+        record = store.get(self.name, self.size)
+        before = None if record is None else record.copy()
+        result = self.run(store)
+        self.before = before
+        self.after = store.get(self.name, self.size).copy()
+        return result
+
+    def inverse(self):
+        """Return the command that undoes this one."""
+        return RestoreRow(self.name, self.size, self.before, self.after, self.describe())
+
+
+class AddItem(StockCommand):
+    def __init__(self, name, size, quantity, price):
+        super().__init__(name, size)
+        self.quantity = quantity
+        self.price = price
+
+    def run(self, store):
+        return store.add_item(self.name, self.size, self.quantity, self.price)
+
+    def describe(self):
+        return f"Added {self.quantity} x {self.name} ({self.size}) at ${self.price}"
+
+
+class AddCopies(StockCommand):
+    def __init__(self, name, size, quantity):
+        super().__init__(name, size)
+        self.quantity = quantity
+
+    def run(self, store):
+        return store.add_copies(self.name, self.size, self.quantity)
+
+    def describe(self):
+        return f"Added {self.quantity} copies to '{self.name}' ({self.size})"
+
+
+class SellCopies(StockCommand):
+    def __init__(self, name, size, quantity):
+        super().__init__(name, size)
+        self.quantity = quantity
+
+    def run(self, store):
+        return store.sell_copies(self.name, self.size, self.quantity)
+
+    def describe(self):
+        return f"Sold {self.quantity} copies of '{self.name}' ({self.size})"
+
+
+class SetPrice(StockCommand):
+    def __init__(self, name, size, price):
+        super().__init__(name, size)
+        self.price = price
+
+    def run(self, store):
+        return store.set_price(self.name, self.size, self.price)
+
+    def describe(self):
+        return f"Updated price for '{self.name}' ({self.size}) to ${self.price}"
+
+
+class RestoreRow:
+    """Puts one item size back to a remembered row, or removes it if it did not exist; its inverse redoes."""
+
+    def __init__(self, name, size, state, replaced, description):
+        """Initialize the command; replaced is the row it overwrites, kept for the inverse."""
+        self.name = name
+        self.size = size
+        self.state = state
+        self.replaced = replaced
+        self.description = description
+
+    def execute(self, store):
+        """Restore the row; only this one item size is touched.
+
+        Raises StockError if the row is no longer as this command left it, because another till has
+        changed it since, rather than overwriting that change.
+        """
+        current = store.get(self.name, self.size)
+        if not same_row(current, self.replaced):
+            raise StockError(f"'{self.name}' ({self.size}) has been changed by another till since, "
+                             "so this change cannot be undone or redone.")
+        return store.restore(self.name, self.size, self.state)
+
+    def inverse(self):
+        """Return the command that puts back the row this one replaces."""
+        return RestoreRow(self.name, self.size, self.replaced, self.state, self.description)
+
+    def describe(self):
+        return self.description
+
+
+class CommandHistory:
+    """Undo and redo stacks of the changes made to a stock store."""
+
+    def __init__(self, store, limit=UNDO_LIMIT):
+        """Initialize empty stacks for the store."""
+        # A proxy, so the history kept alongside a store does not keep the store alive
+        self.store = weakref.proxy(store)
+        self.undo_stack = deque(maxlen=limit)
+        self.redo_stack = deque(maxlen=limit)
+
+    def execute(self, command):
+        """Run a command and make it the next one to undo; anything that could be redone is dropped."""
+        with self.store.transaction():
+            result = command.execute(self.store)
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+        return result
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self):
+        """Undo the most recent change and return (description, restored record or None).
+
+        A change another till has built on since cannot be undone; it is dropped and StockError is raised.
+        """
+        inverse = self.undo_stack.pop().inverse()
+        with self.store.transaction():
+            record = inverse.execute(self.store)
+        self.redo_stack.append(inverse)
+        return inverse.describe(), record
+
+    def redo(self):
+        """Redo the most recently undone change and return (description, restored record)."""
+        command = self.redo_stack.pop().inverse()
+        with self.store.transaction():
+            record = command.execute(self.store)
+        self.undo_stack.append(command)
+        return command.describe(), record
+
+
+_histories = weakref.WeakKeyDictionary()
+
+
+def command_history_for(store):
+    """Return the undo and redo history of a stock store."""
+    history = _histories.get(store)
+    if history is None:
+        history = _histories[store] = CommandHistory(store)
+    return history
@@ -0,0 +1,206 @@
+import heapq
+import re
+import weakref
+from collections import Counter
+from difflib import SequenceMatcher
+
+# Names that go on to full fuzzy scoring after trigram pruning
+MAX_CANDIDATES = 50
+
+# Trigrams shared by more names than this are skipped once rarer trigrams have found candidates
+MAX_POSTING_SIZE = 5000
+
+
+def normalize_name(name):
+    """Lowercase a name and reduce punctuation and repeated spaces to single spaces."""
+    return " ".join(re.sub(r"\W+", " ", name.lower()).split())
+
+
+def name_trigrams(normalized):
+    """Return the trigrams of a normalized name, padded so short names still have some."""
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Helper function for fuzzywuzzy's default processing: keep letters and digits, lowercase, strip
+def full_process(text):
+    text = text.encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"(?ui)\W", " ", text).lower().strip()
+
+
+def ratio(s1, s2):
+    """Return the difflib similarity of two strings as a 0-100 score."""
+    if s1 == s2:
+        return 100
+    if not s1 or not s2:
+        return 0
+    return round(100 * SequenceMatcher(None, s1, s2).ratio())
+
+
+def partial_ratio(s1, s2):
+    """Return the best ratio of the shorter string against same-length slices of the longer one."""
+    if s1 == s2:
+        return 100
+    if not s1 or not s2:
+        return 0
+    shorter, longer = (s1, s2) if len(s1) <= len(s2) else (s2, s1)
+    scores = []
+    for block in SequenceMatcher(None, shorter, longer).get_matching_blocks():
+        long_start = max(block[1] - block[0], 0)
+        score = SequenceMatcher(None, shorter, longer[long_start:long_start + len(shorter)]).ratio()
+        if score > .995:
+            return 100
+        scores.append(score)
+    return round(100 * max(scores))
+
+
+def _sorted_tokens(text):
+    return " ".join(sorted(text.split()))
+
+
+def _token_set_ratio(s1, s2, scorer):
+    tokens1, tokens2 = set(s1.split()), set(s2.split())
+    common = " ".join(sorted(tokens1 & tokens2))
+    combined_1to2 = (common + " " + " ".join(sorted(tokens1 - tokens2))).strip()
+    combined_2to1 = (common + " " + " ".join(sorted(tokens2 - tokens1))).strip()
+    return max(scorer(common, combined_1to2), scorer(common, combined_2to1), scorer(combined_1to2, combined_2to1))
+
+
+def weighted_ratio(s1, s2):
+    """Return fuzzywuzzy's WRatio score for two already processed strings."""
+    if not s1 or not s2:
+        return 0
+    base = ratio(s1, s2)
+    length_ratio = max(len(s1), len(s2)) / min(len(s1), len(s2))
+    if length_ratio < 1.5:
+        return round(max(base,
+                         ratio(_sorted_tokens(s1), _sorted_tokens(s2)) * .95,
+                         _token_set_ratio(s1, s2, ratio) * .95))
+    partial_scale = .6 if length_ratio > 8 else .9
+    return round(max(base,
+                     partial_ratio(s1, s2) * partial_scale,
+                     partial_ratio(_sorted_tokens(s1), _sorted_tokens(s2)) * .95 * partial_scale,
+                     _token_set_ratio(s1, s2, partial_ratio) * .95 * partial_scale))
+
+
+class PythonEngine:
+    """Built-in pure-Python scorer that reproduces fuzzywuzzy's WRatio without any dependency."""
+    name = "python"
+
+    def extract_one(self, query, choices, score_cutoff):
+        """Return (choice, score) for the best choice scoring at least score_cutoff, or None."""
+        processed = full_process(query)
+        best = None
+        for choice in choices:
+            score = weighted_ratio(processed, full_process(choice))
+            if score >= score_cutoff and (best is None or score > best[1]):
+                best = (choice, score)
+        return best
+
+
+class FuzzywuzzyEngine:
+    """Scorer backed by fuzzywuzzy's process.extractOne."""
+    name = "fuzzywuzzy"
+
+    def __init__(self):
+        """Import fuzzywuzzy; raises ImportError when it is not installed."""
+        from fuzzywuzzy import process
+        self.process = process
+
+    def extract_one(self, query, choices, score_cutoff):
+        """Return (choice, score) for the best choice scoring at least score_cutoff, or None."""
+        return self.process.extractOne(query, choices, score_cutoff=score_cutoff)
+
+
+class RapidfuzzEngine:
+    """C-accelerated scorer backed by rapidfuzz, using the same WRatio scoring as fuzzywuzzy."""
+    name = "rapidfuzz"
+
+    def __init__(self):
+        """Import rapidfuzz; raises ImportError when it is not installed."""
+        from rapidfuzz import fuzz, process, utils
+        self.fuzz, self.process, self.utils = fuzz, process, utils
+
+    def extract_one(self, query, choices, score_cutoff):
+        """Return (choice, score) for the best choice scoring at least score_cutoff, or None."""
+        result = self.process.extractOne(query, choices, scorer=self.fuzz.WRatio,
+                                         processor=self.utils.default_process, score_cutoff=score_cutoff)
+        if result is None:
+            return None
+        return result[0], round(result[1])
+
+
+ENGINES = {engine.name: engine for engine in (RapidfuzzEngine, FuzzywuzzyEngine, PythonEngine)}
+
+
+def get_engine(name=None):
+    """Return the named matching engine, or the fastest one installed when no name is given."""
+    if name is not None:
+        return ENGINES[name]()
+    for engine in ENGINES.values():
+        try:
+            return engine()
+        except ImportError:
+            continue
+
+
+class SimilarNameIndex:
+    """Deduplicated item names with trigram pruning, so only a few candidates are fuzzy scored."""
+
+    def __init__(self, names=(), engine=None):
+        """Build the index from an iterable of item names, scoring with the given engine."""
+        self.engine = engine or get_engine()
+        self._names = {}  # normalized name -> first original name seen with it
+        self._postings = {}  # trigram -> set of normalized names containing it
+        self._gram_counts = {}  # normalized name -> number of trigrams it has
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        """Index a name; names that normalize to an indexed name are ignored."""
+        normalized = normalize_name(name)
+        if normalized in self._names:
+            return
+        self._names[normalized] = name
+        grams = name_trigrams(normalized)
+        self._gram_counts[normalized] = len(grams)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(normalized)
+
+    def candidates(self, name, limit=MAX_CANDIDATES):
+        """Return the original names whose trigrams overlap most with the given name's.
+
+        Shared trigrams are counted as a share of the trigrams the two names have between them, so long
+        names do not crowd out short ones just by having more trigrams.
+        """
+        normalized = normalize_name(name)
+        grams = name_trigrams(normalized)
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        counts = Counter()
+        for posting in postings:
+            if len(posting) > MAX_POSTING_SIZE and counts:
+                break
+            counts.update(posting)
+        best = heapq.nlargest(limit, counts.items(), key=lambda item: item[1] / (
+            len(grams) + self._gram_counts[item[0]] - item[1]))
+        return [self._names[match] for match, _ in best]
+
+    def find_similar(self, name, score_cutoff=85):
+        """Return (name, score) for the best match scoring at least score_cutoff, or None."""
+        return self.engine.extract_one(name, self.candidates(name), score_cutoff)
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def similarity_index_for(store, engine_name=None):
+    """Return the similarity index for a stock store, building it on first use and keeping it current."""
+    index = _indexes.get(store)
+    if index is None:
+        index = SimilarNameIndex(store.names(), engine=get_engine(engine_name))
+        store.subscribe(lambda op, record: index.add(record.name), remote=True)
+        _indexes[store] = index
+    return index
@@ -0,0 +1,404 @@
+import argparse
+import functools
+import re
+import sqlite3
+import sys
+import time
+import weakref
+from datetime import datetime, timedelta
+
+from stock_store import StockRecord, StockStore
+
+HISTORY_FILENAME = "stock_history.db"
+
+# Checkpoint the stock after this many changes, so rebuilding the stock at any time replays at most
+# this many events on top of the checkpoint before it
+CHECKPOINT_EVERY = 1000
+
+# Every this many checkpoints, copy the whole stock; the ones in between copy only the items changed since
+# the checkpoint before, so a checkpoint costs about as much as the changes it follows
+FULL_CHECKPOINT_EVERY = 20
+
+# Periods the changes are rolled up by
+PERIODS = ("hour", "day", "week")
+
+
+# Helper function for the first of two values that is not None, like SQL's coalesce
+def coalesce(value, fallback):
+    return fallback if value is None else value
+
+
+# Helper function for finding the bucket a timestamp falls in, labelled with its local start time; a batch
+# of changes usually shares one timestamp, so recent answers are cached
+@functools.lru_cache(maxsize=1024)
+def bucket_for(period, timestamp):
+    moment = datetime.fromtimestamp(timestamp)
+    if period == "hour":
+        return moment.strftime("%Y-%m-%d %H:00")
+    if period == "day":
+        return moment.strftime("%Y-%m-%d")
+    if period == "week":
+        return (moment - timedelta(days=moment.weekday())).strftime("%Y-%m-%d")
+    raise ValueError(f"Unknown period '{period}'.")
+
+
+class StockHistory:
+    """Timestamped quantity and price changes per (name, size), with hourly, daily and weekly rollups.
+
+    Each change is stored once as an event and folded into one row per period at the same time, so
+    charts read a few rollup rows and never the raw history. Every checkpoint_every events the items
+    changed since the last checkpoint are copied into a new one, and every FULL_CHECKPOINT_EVERY checkpoints
+    the whole stock is; the stock at any later time is rebuilt from the last full checkpoint before it, the
+    checkpoints since and the events since.
+    """
+
+    def __init__(self, filename=HISTORY_FILENAME, checkpoint_every=CHECKPOINT_EVERY):
+        """Open the history database and create its tables if needed."""
+        self.filename = filename
+        self.checkpoint_every = checkpoint_every
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            # quantity or price_cents is NULL when a change did not record it (legacy price-only lines)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "ts REAL NOT NULL, name TEXT NOT NULL, size TEXT NOT NULL, quantity INTEGER, "
+                "price_cents INTEGER, change INTEGER NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS events_item ON events (name, size, ts)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS events_ts ON events (ts)")
+            # Last known quantity and price of every item, to work out how much each change added or sold
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS current ("
+                "name TEXT NOT NULL, size TEXT NOT NULL, quantity INTEGER, price_cents INTEGER, "
+                "ts REAL NOT NULL, PRIMARY KEY (name, size))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                "period TEXT NOT NULL, bucket TEXT NOT NULL, name TEXT NOT NULL, size TEXT NOT NULL, "
+                "quantity INTEGER, price_cents INTEGER, units_added INTEGER NOT NULL, "
+                "units_sold INTEGER NOT NULL, changes INTEGER NOT NULL, last_ts REAL NOT NULL, "
+                "PRIMARY KEY (name, size, period, bucket))")
+            # Copies of the stock; last_event is the rowid of the newest event included. base is NULL for a
+            # copy of the whole stock, or the full checkpoint that a copy of only the changed items builds on
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, last_event INTEGER NOT NULL, base INTEGER)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checkpoints)")]
+            if 'base' not in columns:
+                # Databases from before incremental checkpoints: all their checkpoints are full
+                self.connection.execute("ALTER TABLE checkpoints ADD COLUMN base INTEGER")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS checkpoints_ts ON checkpoints (ts)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_rows ("
+                "checkpoint INTEGER NOT NULL, name TEXT NOT NULL, size TEXT NOT NULL, quantity INTEGER, "
+                "price_cents INTEGER, PRIMARY KEY (checkpoint, name, size))")
+        last = self.connection.execute("SELECT max(last_event) FROM checkpoints").fetchone()[0]
+        self.events_since_checkpoint = self.connection.execute(
+            "SELECT count(*) FROM events WHERE rowid > ?", (last or 0,)).fetchone()[0]
+
+    def has_baseline(self):
+        """Check if the quantities of the whole stock have been recorded once."""
+        return self.connection.execute("PRAGMA user_version").fetchone()[0] >= 1
+
+    def baseline(self, store, timestamp=None):
+        """Remember the current quantity and price of every item not seen yet, without recording events."""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO current (name, size, quantity, price_cents, ts) VALUES (?, ?, ?, ?, ?)",
+                ((record.name, record.size, record.quantity, record.price_cents, timestamp) for record in store))
+            self.connection.execute("PRAGMA user_version = 1")
+        # The first checkpoint is the starting point for rebuilding the stock at any later time
+        self.checkpoint(timestamp, full=True)
+
+    def _known(self, keys):
+        """Return {(name, size): [quantity, price_cents, ts]} for the keys with a last known state."""
+        # Joined through a temporary table, so each key is one primary key lookup
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS batch_keys (name TEXT NOT NULL, size TEXT NOT NULL)")
+        self.connection.execute("DELETE FROM batch_keys")
+        self.connection.executemany("INSERT INTO batch_keys (name, size) VALUES (?, ?)", keys)
+        rows = self.connection.execute(
+            "SELECT current.name, current.size, quantity, price_cents, ts FROM batch_keys "
+            "JOIN current ON current.name = batch_keys.name AND current.size = batch_keys.size")
+        return {(name, size): [quantity, price_cents, ts] for name, size, quantity, price_cents, ts in rows}
+
+    def record(self, record, timestamp=None, removed=False):
+        """Record the new quantity and price of a changed StockRecord; a removed item is recorded as empty."""
+        timestamp = time.time() if timestamp is None else timestamp
+        self.record_many([(timestamp, record.name, record.size, 0 if removed else record.quantity,
+                           record.price_cents)])
+
+    def record_many(self, changes):
+        """Record (timestamp, name, size, quantity, price_cents[, change]) changes in one transaction.
+
+        The units added (positive change) or sold (negative) are worked out from the last known quantity
+        unless the change gives them. The last known states are looked up and the rollups summed per
+        bucket first, so each item and each bucket is written once however many changes it had.
+        """
+        changes = [change if len(change) == 6 else tuple(change) + (None,) for change in changes]
+        known = self._known(dict.fromkeys((name, size) for timestamp, name, size, *rest in changes))
+        events = []
+        touched = {}
+        rollups = {}  # (name, size, period, bucket) -> [quantity, price_cents, added, sold, changes, last_ts]
+        for timestamp, name, size, quantity, price_cents, change in changes:
+            state = known.get((name, size))
+            if change is None:
+                previous = state[0] if state is not None and state[0] is not None else 0
+                change = 0 if quantity is None else quantity - previous
+            events.append((timestamp, name, size, quantity, price_cents, change))
+            if state is None:
+                state = known[(name, size)] = [quantity, price_cents, timestamp]
+                touched[(name, size)] = state
+            elif state[2] <= timestamp:
+                state[:] = [coalesce(quantity, state[0]), coalesce(price_cents, state[1]), timestamp]
+                touched[(name, size)] = state
+            for period in PERIODS:
+                key = (name, size, period, bucket_for(period, timestamp))
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollups[key] = [quantity, price_cents, max(change, 0), max(-change, 0), 1, timestamp]
+                    continue
+                # Closing values are only replaced by changes at least as recent as the ones already folded in
+                if timestamp >= rollup[5]:
+                    rollup[0], rollup[1] = coalesce(quantity, rollup[0]), coalesce(price_cents, rollup[1])
+                else:
+                    rollup[0], rollup[1] = coalesce(rollup[0], quantity), coalesce(rollup[1], price_cents)
+                rollup[2] += max(change, 0)
+                rollup[3] += max(-change, 0)
+                rollup[4] += 1
+                rollup[5] = max(rollup[5], timestamp)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO events (ts, name, size, quantity, price_cents, change) VALUES (?, ?, ?, ?, ?, ?)",
+                events)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO current (name, size, quantity, price_cents, ts) VALUES (?, ?, ?, ?, ?)",
+                (key + tuple(state) for key, state in touched.items()))
+            # The same rule again for buckets that already have changes from earlier batches
+            self.connection.executemany(
+                "INSERT INTO rollups (name, size, period, bucket, quantity, price_cents, units_added, units_sold, "
+                "changes, last_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name, size, period, bucket) DO UPDATE SET "
+                "quantity = CASE WHEN excluded.last_ts >= last_ts THEN coalesce(excluded.quantity, quantity) "
+                "ELSE coalesce(quantity, excluded.quantity) END, "
+                "price_cents = CASE WHEN excluded.last_ts >= last_ts "
+                "THEN coalesce(excluded.price_cents, price_cents) ELSE coalesce(price_cents, excluded.price_cents) END, "
+                "units_added = units_added + excluded.units_added, units_sold = units_sold + excluded.units_sold, "
+                "changes = changes + excluded.changes, last_ts = max(last_ts, excluded.last_ts)",
+                (key + tuple(rollup) for key, rollup in rollups.items()))
+        self.events_since_checkpoint += len(events)
+        if self.events_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+        return len(events)
+
+    def checkpoint(self, timestamp=None, full=False):
+        """Copy the latest quantity and price of the items changed since the last checkpoint into a new one.
+
+        The whole stock is copied instead when full is set, when there is no full checkpoint yet, and every
+        FULL_CHECKPOINT_EVERY checkpoints.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.connection:
+            last_event = self.connection.execute("SELECT coalesce(max(rowid), 0) FROM events").fetchone()[0]
+            base, previous_event = self.connection.execute(
+                "SELECT max(id), max(last_event) FROM checkpoints WHERE base IS NULL").fetchone()
+            if base is not None and not full:
+                since_base, latest_event = self.connection.execute(
+                    "SELECT count(*), max(last_event) FROM checkpoints WHERE id > ?", (base,)).fetchone()
+                if since_base:
+                    previous_event = latest_event
+                full = since_base + 1 >= FULL_CHECKPOINT_EVERY
+            if base is None or full:
+                checkpoint = self.connection.execute(
+                    "INSERT INTO checkpoints (ts, last_event) VALUES (?, ?)", (timestamp, last_event)).lastrowid
+                self.connection.execute(
+                    "INSERT INTO checkpoint_rows (checkpoint, name, size, quantity, price_cents) "
+                    "SELECT ?, name, size, quantity, price_cents FROM current", (checkpoint,))
+            else:
+                checkpoint = self.connection.execute(
+                    "INSERT INTO checkpoints (ts, last_event, base) VALUES (?, ?, ?)",
+                    (timestamp, last_event, base)).lastrowid
+                self.connection.execute(
+                    "INSERT INTO checkpoint_rows (checkpoint, name, size, quantity, price_cents) "
+                    "SELECT ?, name, size, quantity, price_cents FROM current WHERE (name, size) IN "
+                    "(SELECT name, size FROM events WHERE rowid > ?)", (checkpoint, previous_event or 0))
+        self.events_since_checkpoint = 0
+
+    def stock_at(self, timestamp):
+        """Rebuild the stock as it was at a time from the checkpoints before it and the events since.
+
+        Items that were removed show up with no copies. Before the first checkpoint only the recorded
+        events are replayed, so items that did not change are missing.
+        """
+        checkpoint = self.connection.execute(
+            "SELECT id, ts, coalesce(base, id) FROM checkpoints WHERE ts <= ? ORDER BY ts DESC, id DESC LIMIT 1",
+            (timestamp,)).fetchone()
+        rows = {}
+        since = float("-inf")
+        if checkpoint is not None:
+            checkpoint, since, base = checkpoint
+            # The full checkpoint, then the changed items of each checkpoint after it, oldest first
+            cursor = self.connection.execute(
+                "SELECT name, size, quantity, price_cents FROM checkpoint_rows WHERE checkpoint = ? OR "
+                "checkpoint IN (SELECT id FROM checkpoints WHERE base = ? AND id <= ?) ORDER BY checkpoint",
+                (base, base, checkpoint))
+            rows = {(name, size): [quantity, price_cents] for name, size, quantity, price_cents in cursor}
+        events = self.connection.execute(
+            "SELECT name, size, quantity, price_cents FROM events WHERE ts > ? AND ts <= ? ORDER BY ts, rowid",
+            (since, timestamp))
+        for name, size, quantity, price_cents in events:
+            row = rows.setdefault((name, size), [None, None])
+            # Legacy log lines recorded only the quantity or only the price
+            if quantity is not None:
+                row[0] = quantity
+            if price_cents is not None:
+                row[1] = price_cents
+
+        # Items whose quantity was never recorded (price-only log lines) are left out
+        return StockStore(StockRecord(name, size, quantity, price_cents or 0, quantity > 0)
+                          for (name, size), (quantity, price_cents) in rows.items() if quantity is not None)
+
+    def item_at(self, name, size, timestamp):
+        """Return (quantity, price_cents) of one item size at a time, or None if nothing was recorded."""
+        quantity = price_cents = None
+        checkpoint = self.connection.execute(
+            "SELECT checkpoint_rows.quantity, checkpoint_rows.price_cents, checkpoints.ts FROM checkpoint_rows "
+            "JOIN checkpoints ON checkpoints.id = checkpoint_rows.checkpoint "
+            "WHERE name = ? AND size = ? AND checkpoints.ts <= ? ORDER BY checkpoints.ts DESC LIMIT 1",
+            (name, size, timestamp)).fetchone()
+        since = float("-inf")
+        if checkpoint is not None:
+            quantity, price_cents, since = checkpoint
+        events = self.connection.execute(
+            "SELECT quantity, price_cents FROM events WHERE name = ? AND size = ? AND ts > ? AND ts <= ? "
+            "ORDER BY ts, rowid", (name, size, since, timestamp))
+        found = checkpoint is not None
+        for event_quantity, event_price_cents in events:
+            found = True
+            if event_quantity is not None:
+                quantity = event_quantity
+            if event_price_cents is not None:
+                price_cents = event_price_cents
+        return (quantity, price_cents) if found else None
+
+    def rollups(self, name, size, period="day", limit=None):
+        """Return (bucket, quantity, price_cents, units_added, units_sold, changes) rows, oldest first.
+
+        With a limit, only the most recent buckets are returned.
+        """
+        query = ("SELECT bucket, quantity, price_cents, units_added, units_sold, changes FROM rollups "
+                 "WHERE name = ? AND size = ? AND period = ? ORDER BY bucket DESC")
+        parameters = (name, size, period)
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters += (limit,)
+        return self.connection.execute(query, parameters).fetchall()[::-1]
+
+    def close(self):
+        """Close the history database."""
+        self.connection.close()
+
+
+_recorders = weakref.WeakKeyDictionary()
+
+
+def record_history(store, filename=HISTORY_FILENAME, checkpoint_every=CHECKPOINT_EVERY):
+    """Record every later change of a stock store in the history database and return the history."""
+    history = _recorders.get(store)
+    if history is None:
+        history = StockHistory(filename, checkpoint_every)
+        if not history.has_baseline():
+            # First run: without a starting point the first change of each item could not tell sales from restocks
+            history.baseline(store)
+        store.subscribe(lambda op, record: history.record(record, removed=op == "remove"))
+        _recorders[store] = history
+    return history
+
+
+# The free-text lines main_v3 has always written to stock_control.log
+LOG_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - \w+ - (.*)$")
+LOG_MESSAGES = [
+    (re.compile(r"^Added new stock item: (.*) \((.*?)\) with quantity (\d+) and price \$([\d.]+)\.$"),
+     lambda match: (match[1], match[2], int(match[3]), round(float(match[4]) * 100), None)),
+    (re.compile(r"^Added (\d+) copies to '(.*)' \((.*?)\)\. New quantity: (-?\d+)\.$"),
+     lambda match: (match[2], match[3], max(int(match[4]), 0), None, int(match[1]))),
+    (re.compile(r"^Sold (\d+) copies of '(.*)' \((.*?)\)\. New quantity: (-?\d+)\.$"),
+     lambda match: (match[2], match[3], max(int(match[4]), 0), None, -int(match[1]))),
+    (re.compile(r"^Updated price for '(.*)' \((.*?)\) to \$([\d.]+)\.$"),
+     lambda match: (match[1], match[2], None, round(float(match[3]) * 100), 0)),
+]
+
+
+def iter_log_changes(filename):
+    """Yield (timestamp, name, size, quantity, price_cents, change) for each stock change in a legacy log file."""
+    with open(filename, mode='r') as file:
+        for line in file:
+            line_match = LOG_LINE.match(line.rstrip("\n"))
+            if line_match is None:
+                continue
+            for pattern, parse in LOG_MESSAGES:
+                match = pattern.match(line_match[3])
+                if match is not None:
+                    logged_at = datetime.strptime(line_match[1], "%Y-%m-%d %H:%M:%S").timestamp()
+                    yield (logged_at + int(line_match[2]) / 1000,) + parse(match)
+                    break
+
+
+def parse_time(text):
+    """Parse "YYYY-MM-DD" (the end of that day) or "YYYY-MM-DD HH:MM[:SS]" as a local timestamp."""
+    moment = datetime.fromisoformat(text)
+    if len(text) <= len("YYYY-MM-DD"):
+        moment += timedelta(days=1, microseconds=-1)
+    return moment.timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stock history tools.")
+    parser.add_argument("--history", default=HISTORY_FILENAME, help="stock history database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="import the changes already in the text log, once")
+    import_parser.add_argument("log", help="stock_control.log")
+
+    at_parser = commands.add_parser("at", help="show the stock as it was at a time")
+    at_parser.add_argument("time", help='"YYYY-MM-DD" (end of that day) or "YYYY-MM-DD HH:MM"')
+    at_parser.add_argument("--item", help="only this item")
+    at_parser.add_argument("--size", help="only this size of the item")
+
+    restore_parser = commands.add_parser("restore", help="rebuild a stock CSV file from the history")
+    restore_parser.add_argument("file", help="CSV file to write")
+    restore_parser.add_argument("--at", help="time to rebuild the stock at (default: now)")
+
+    args = parser.parse_args(argv)
+    history = StockHistory(args.history)
+
+    if args.command == "import":
+        imported = history.record_many(iter_log_changes(args.log))
+        print(f"Imported {imported} stock changes from '{args.log}' into '{args.history}'.")
+        return 0
+
+    if args.command == "at" and args.item and args.size:
+        state = history.item_at(args.item, args.size, parse_time(args.time))
+        if state is None or state[0] is None:
+            print(f"No stock recorded for {args.item} ({args.size}) at {args.time}.")
+            return 1
+        price = "unknown" if state[1] is None else f"${state[1] / 100}"
+        print(f"{args.item} ({args.size}) at {args.time}: {state[0]} copies, price {price}.")
+        return 0
+
+    if args.command == "at":
+        for record in history.stock_at(parse_time(args.time)):
+            if args.item is None or record.name == args.item:
+                print(f"{record.name} ({record.size}): {record.quantity} copies, price ${record.price_text}")
+        return 0
+
+    if args.command == "restore":
+        from storage import CsvStorage
+        store = history.stock_at(time.time() if args.at is None else parse_time(args.at))
+        # Under the stock lock, and the journal is emptied: its changes would otherwise be replayed over these rows
+        CsvStorage(args.file).write_rows(store)
+        print(f"Wrote {len(store)} stock rows to '{args.file}'.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
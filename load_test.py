@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlencode
+
+# Share of requests of each kind; sales and restocks alternate so quantities stay put
+REQUEST_MIX = [("lookup", 70), ("search", 10), ("sell", 10), ("restock", 10)]
+
+
+async def request(reader, writer, method, path, body=None):
+    """Send one request on a keep-alive connection and return (status, JSON result)."""
+    payload = b"" if body is None else json.dumps(body).encode('utf-8')
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = (await reader.readline()).strip()
+        if not line:
+            break
+        key, _, value = line.decode('latin-1').partition(":")
+        if key.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+# Helper function for building one request of the given kind for a random item
+def build_request(kind, rng, items):
+    item = rng.choice(items)
+    key = {'name': item['name'], 'size': item['size']}
+    if kind == "lookup":
+        return "GET", "/item?" + urlencode(key), None
+    if kind == "search":
+        return "GET", "/search?" + urlencode({'q': item['name'][:3], 'limit': 20}), None
+    return "POST", f"/{kind}", dict(key, quantity=1)
+
+
+async def client(host, port, count, rng, items, latencies, statuses):
+    """Send count requests one after another over one connection."""
+    reader, writer = await asyncio.open_connection(host, port)
+    kinds, weights = zip(*REQUEST_MIX)
+    try:
+        for _ in range(count):
+            method, path, body = build_request(rng.choices(kinds, weights)[0], rng, items)
+            started = time.perf_counter()
+            status, _ = await request(reader, writer, method, path, body)
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    status, result = await request(reader, writer, "GET", "/search?q=&limit=1000")
+    writer.close()
+    items = result['items']
+    if not items:
+        raise SystemExit("The stock is empty; add some items before load testing.")
+
+    latencies = []
+    statuses = {}
+    rng = random.Random(args.seed)
+    per_client = args.requests // args.concurrency
+    started = time.perf_counter()
+    await asyncio.gather(*(client(args.host, args.port, per_client, random.Random(rng.random()), items,
+                                  latencies, statuses) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{len(latencies)} requests from {args.concurrency} connections in {elapsed:.2f} s")
+    print(f"Throughput: {len(latencies) / elapsed:,.0f} requests/s")
+    print(f"Latency: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    print("Responses: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running stock_server.py.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=10000, help="total requests to send")
+    parser.add_argument("--concurrency", type=int, default=50, help="connections sending requests at once")
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
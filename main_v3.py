@@ -1,40 +1,188 @@
-import csv
+import time
+
+_import_started = time.perf_counter()
+
+import argparse
+import itertools
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
-from fuzzywuzzy import process
+from tkinter import ttk, messagebox
 import logging
+from audit_log import audit, setup_logging
+from stock_store import StockStore, StockError, is_valid_price, validate_new_item
+
+# Storage, search and fuzzy matching modules are imported by the first screen that needs them
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+# Set up logging: a background thread writes stock_control.log and the structured audit log, so slow
+# disks never hold up the window
+setup_logging('stock_control.log')
+
+# Where stock is stored: "csv" (stock.csv plus its journal) or "sqlite" (DATABASE_FILENAME)
+STORAGE_BACKEND = "csv"
+DATABASE_FILENAME = "stock.db"
+
+# Append each change to a journal instead of rewriting the whole CSV after every mutation
+JOURNAL_MODE = True
+
+# Every journaled change is flushed to disk before the click returns. Set this to a number of milliseconds to
+# flush changes made in quick succession together instead; a crash then loses at most that much
+GROUP_COMMIT_MS = None
+
+# Fuzzy matching engine for duplicate detection: "rapidfuzz", "fuzzywuzzy", "python", or None for the fastest installed
+FUZZY_ENGINE = None
+
+# Delay after the last keystroke before the viewer runs a search
+SEARCH_DEBOUNCE_MS = 150
+
+# Rows the viewer adds to its table at a time; more are fetched as the user scrolls down
+VIEWER_PAGE_SIZE = 100
+
+# Items listed in the Reports screen's per-item table, highest stock value first
+REPORT_TOP_ITEMS = 100
 
-# Set up logging configuration
-logging.basicConfig(filename='stock_control.log',
-                    level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# Record every stock change in HISTORY_FILENAME (stock_history.db) for the Stock Trends charts
+RECORD_HISTORY = True
 
+# Changes between full-stock checkpoints in the history; looking up the stock at a past time replays at most
+# this many changes (python history.py at "2024-09-03" --item "Zapa" --size L)
+HISTORY_CHECKPOINT_EVERY = 1000
 
-# Helper function for reading stock from CSV
-def read_stock_from_csv(filename):
-    stock = []
+# Most recent hours, days or weeks drawn in a Stock Trends chart
+TREND_BUCKETS = 30
+
+
+# Helper function for opening the configured storage backend
+def open_storage(filename):
+    import storage
+    return storage.open_storage(STORAGE_BACKEND, filename, DATABASE_FILENAME, journal_mode=JOURNAL_MODE,
+                                group_commit_ms=GROUP_COMMIT_MS)
+
+
+# Helper function for reading stock from the storage backend; a file that cannot be read gives no rows and the
+# error to show
+def read_stock_from_csv(filename, storage=None):
+    import sqlite3
     try:
-        with open(filename, mode='r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                stock.append(row)
+        return (storage or open_storage(filename)).read_rows(), None
     except FileNotFoundError:
-        messagebox.showerror("Error", f"Stock file '{filename}' not found.")
-    return stock
+        return [], f"Stock file '{filename}' not found."
+    except sqlite3.Error:
+        return [], f"Failed to read stock database '{DATABASE_FILENAME}'."
+
+
+# Stores shared by every window, keyed by filename: (storage, store, on-disk signature)
+_stock_cache = {}
 
 
-# Helper function for writing stock to CSV
-def write_stock_to_csv(filename, stock_items):
+# Helper function for getting the shared store, if it is loaded, with changes from other tills merged in
+def cached_stock(filename):
+    cached = _stock_cache.get(filename)
+    if cached is None:
+        return None
+    storage, store, signature = cached
+    if storage.signature() != signature:
+        import sqlite3
+        try:
+            # Another till saved changes: bring just those rows up to date instead of reloading everything
+            storage.sync(store)
+        except (IOError, sqlite3.Error):
+            del _stock_cache[filename]
+            return None
+        _stock_cache[filename] = (storage, store, storage.signature())
+    return store
+
+
+# Helper function for loading stock and keeping it saved as it changes; returns the store and an error to show,
+# or None. Runs as a background store job, like everything else that uses the store
+def load_stock(filename):
+    store = cached_stock(filename)
+    if store is not None:
+        return store, None
+
+    storage = open_storage(filename)
+    rows, error = read_stock_from_csv(filename, storage)
+    store = storage.attach(StockStore(rows))
+
+    def remember_signature(op=None, record=None):
+        # Our own writes change the files too; record them so they do not count as outside changes
+        _stock_cache[filename] = (storage, store, storage.signature())
+
+    remember_signature()
+    store.subscribe(remember_signature)
+    if RECORD_HISTORY:
+        from history import record_history
+        record_history(store, checkpoint_every=HISTORY_CHECKPOINT_EVERY)
+    return store, error
+
+
+# Helper function for loading the stock with a copy of its item names and the sizes of each, for the dropdowns;
+# the store changes on the background thread, so the Tk thread reads the copy instead
+def load_stock_catalog(filename):
+    store, error = load_stock(filename)
+    return store, {name: store.sizes(name) for name in store.names()}, error
+
+
+# Helper function for reading stock row by row without loading all of it into memory
+def iter_stock(filename, available_only=False):
+    store = cached_stock(filename)
+    if store is not None:
+        # Already in memory, so there is nothing to save by reading the file again
+        if available_only:
+            return (record for record in store if record.available)
+        return iter(store)
+    return open_storage(filename).iter_rows(available_only)
+
+
+# Helper function for flushing pending changes before the program exits
+def compact_stock(filename):
+    import sqlite3
     try:
-        with open(filename, mode='w', newline='') as file:
-            fieldnames = ['name', 'quantity', 'price', 'size', 'availability']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(stock_items)
-    except IOError:
+        open_storage(filename).compact()
+    except FileNotFoundError:
+        pass
+    except (IOError, sqlite3.Error):
         messagebox.showerror("Error", f"Failed to write to file '{filename}'.")
 
 
+# Background jobs shared by every window; created by the first window that runs one
+_background_jobs = None
+
+
+# Helper function for reporting a background job that failed
+def show_job_error(error):
+    import sqlite3
+    if isinstance(error, StockError):
+        messagebox.showerror("Error", str(error))
+    elif isinstance(error, FileNotFoundError):
+        messagebox.showerror("Error", f"Stock file '{error.filename}' not found.")
+    elif isinstance(error, sqlite3.Error):
+        messagebox.showerror("Error", f"Failed to use stock database '{DATABASE_FILENAME}'.")
+    elif isinstance(error, IOError):
+        messagebox.showerror("Error", f"Failed to write to file '{error.filename}'.")
+    else:
+        raise error
+
+
+# Helper function for running a job off the Tk thread and handing its result to on_done on the Tk thread
+def run_in_background(widget, job, on_done, progress=None, buttons=()):
+    global _background_jobs
+    if _background_jobs is None:
+        from background import BackgroundJobs
+        _background_jobs = BackgroundJobs()
+    return _background_jobs.submit(widget, job, on_done, show_job_error, progress, buttons)
+
+
+# Helper function for letting the store jobs still queued finish before the program exits
+def finish_background_jobs():
+    if _background_jobs is not None:
+        _background_jobs.shutdown()
+
+
+# Helper function for the progress bar a window shows while it waits for a background job
+def progress_bar(parent):
+    return ttk.Progressbar(parent, mode="indeterminate", length=200)
+
+
 # Helper function for centering a window
 def center_window(window, width=400, height=300):
     window.update_idletasks()
@@ -47,50 +195,63 @@ def center_window(window, width=400, height=300):
 
 class StockManager:
     FILENAME = "stock.csv"
+    TITLE = "Stock Control - Add Stock"
+    WIDTH, HEIGHT = 400, 340
+    RESIZABLE = False
 
-    def __init__(self, main_menu_callback):
+    def __init__(self, parent, main_menu_callback):
         """Initialize the StockManager class."""
         self.main_menu_callback = main_menu_callback
-        self.root = tk.Tk()
-        self.root.title("Stock Control - Add Stock")
-
-        # Set window size and center it
-        self.root.geometry("400x300")
-        self.root.resizable(False, False)
-        center_window(self.root)
+        self.frame = tk.Frame(parent)
 
-        # Read existing stock data
-        self.stock_items = read_stock_from_csv(self.FILENAME)
         sizes = ["XS", "S", "M", "L", "XL"]
 
         # Entry for item name
-        tk.Label(self.root, text="Item Name", font=("Arial", 12)).grid(row=0, column=0, padx=20, pady=10, sticky='e')
+        tk.Label(self.frame, text="Item Name", font=("Arial", 12)).grid(row=0, column=0, padx=20, pady=10, sticky='e')
         self.name_var = tk.StringVar()
-        tk.Entry(self.root, textvariable=self.name_var, font=("Arial", 12)).grid(row=0, column=1, padx=20, pady=10)
+        tk.Entry(self.frame, textvariable=self.name_var, font=("Arial", 12)).grid(row=0, column=1, padx=20, pady=10)
 
         # Dropdown to select size
-        tk.Label(self.root, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=20, pady=10, sticky='e')
-        self.size_dropdown = ttk.Combobox(self.root, values=sizes, font=("Arial", 12))
+        tk.Label(self.frame, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=20, pady=10, sticky='e')
+        self.size_dropdown = ttk.Combobox(self.frame, values=sizes, font=("Arial", 12))
         self.size_dropdown.grid(row=1, column=1, padx=20, pady=10)
 
         # Entry for price
-        tk.Label(self.root, text="Price", font=("Arial", 12)).grid(row=2, column=0, padx=20, pady=10, sticky='e')
+        tk.Label(self.frame, text="Price", font=("Arial", 12)).grid(row=2, column=0, padx=20, pady=10, sticky='e')
         self.price_var = tk.StringVar()
-        tk.Entry(self.root, textvariable=self.price_var, font=("Arial", 12)).grid(row=2, column=1, padx=20, pady=10)
+        tk.Entry(self.frame, textvariable=self.price_var, font=("Arial", 12)).grid(row=2, column=1, padx=20, pady=10)
 
         # Entry for quantity
-        tk.Label(self.root, text="Quantity", font=("Arial", 12)).grid(row=3, column=0, padx=20, pady=10, sticky='e')
+        tk.Label(self.frame, text="Quantity", font=("Arial", 12)).grid(row=3, column=0, padx=20, pady=10, sticky='e')
         self.quantity_var = tk.StringVar()
-        tk.Entry(self.root, textvariable=self.quantity_var, font=("Arial", 12)).grid(row=3, column=1, padx=20, pady=10)
+        tk.Entry(self.frame, textvariable=self.quantity_var, font=("Arial", 12)).grid(row=3, column=1, padx=20, pady=10)
 
-        # Button to add stock
-        tk.Button(self.root, text="Add Stock", command=self.add_stock, font=("Arial", 12)).grid(row=4, column=0,
-                                                                                                columnspan=2, pady=20)
+        # Button to add stock, enabled once the stock is loaded
+        self.add_button = tk.Button(self.frame, text="Add Stock", command=self.add_stock, font=("Arial", 12),
+                                    state=tk.DISABLED)
+        self.add_button.grid(row=4, column=0, columnspan=2, pady=20)
 
         # Button to return to main menu
-        tk.Button(self.root, text="Back to Main Menu", command=self.go_back, font=("Arial", 12)).grid(row=5, column=0,
-                                                                                                      columnspan=2,
-                                                                                                      pady=10)
+        tk.Button(self.frame, text="Back to Main Menu", command=self.go_back, font=("Arial", 12)).grid(row=5, column=0,
+                                                                                                       columnspan=2,
+                                                                                                       pady=10)
+
+        # Runs while the stock is loaded or saved in the background
+        self.progress = progress_bar(self.frame)
+        self.progress.grid(row=6, column=0, columnspan=2)
+
+        self.store = None
+
+    def refresh(self):
+        """Read existing stock data in the background; called each time the screen is shown."""
+        run_in_background(self.frame, lambda: load_stock(self.FILENAME), self.stock_loaded, self.progress)
+
+    def stock_loaded(self, result):
+        """Keep the loaded stock and show any error reading it."""
+        self.store, error = result
+        self.add_button.config(state=tk.NORMAL)
+        if error:
+            messagebox.showerror("Error", error)
 
     def validate_inputs(self):
         """Validate the input fields."""
@@ -98,26 +259,16 @@ class StockManager:
         size = self.size_dropdown.get()
         price = self.price_var.get().strip()
         quantity = self.quantity_var.get().strip()
-
-        if not name:
-            return False, "Item name cannot be empty."
-        if not size:
-            return False, "Size must be selected."
-        if not price or not price.replace('.', '', 1).isdigit() or float(price) <= 0:
-            return False, "Price must be a positive number."
-        if not quantity.isdigit() or int(quantity) <= 0:
-            return False, "Quantity must be a positive integer."
-
-        return True, ""
+        return validate_new_item(name, size, price, quantity)
 
     def item_exists(self, name, size):
         """Check if an item with the same name and size already exists."""
-        return any(item['name'] == name and item['size'] == size for item in self.stock_items)
+        return self.store.exists(name, size)
 
     def find_similar_item(self, name):
         """Find similar item names using fuzzy matching."""
-        names = [item['name'] for item in self.stock_items]
-        return process.extractOne(name, names, score_cutoff=85)
+        from fuzzy_match import similarity_index_for
+        return similarity_index_for(self.store, FUZZY_ENGINE).find_similar(name, score_cutoff=85)
 
     def prompt_user(self, suggested_name, size):
         """Prompt the user to confirm if the suggested item is what they meant."""
@@ -140,93 +291,110 @@ class StockManager:
         price = float(self.price_var.get().strip())
         quantity = int(self.quantity_var.get().strip())
 
-        similar_item = self.find_similar_item(name)
-        if similar_item:
-            suggested_name = similar_item[0]
-            if self.item_exists(suggested_name, size):
-                if self.prompt_user(suggested_name, size):
-                    # User chose "Yes", indicate to update availability
-                    logging.info(f"User chose to update availability for similar item '{suggested_name}' ({size}).")
-                    messagebox.showinfo("Information", "Please go to 'Update Availability' to modify this item.")
-                    return
-                else:
-                    # User chose "No", continue to add the item anyway
-                    pass  # Continue with adding the stock item
-
-        # Add new stock item
-        new_item = {'name': name, 'quantity': str(quantity), 'price': str(price), 'size': size,
-                    'availability': "1" if quantity > 0 else "0"}
-        self.stock_items.append(new_item)
-
-        # Write updated stock data back to CSV
-        write_stock_to_csv(self.FILENAME, self.stock_items)
-        logging.info(f"Added new stock item: {name} ({size}) with quantity {quantity} and price ${price}.")
-        messagebox.showinfo("Success", f"Added new stock item: {name} ({size}).")
+        def find_match():
+            # Matching uses the store's similarity index, so it runs as a store job too
+            similar_item = self.find_similar_item(name)
+            if similar_item and self.item_exists(similar_item[0], size):
+                return similar_item[0]
+            return None
+
+        def match_found(suggested_name):
+            if suggested_name is not None and self.prompt_user(suggested_name, size):
+                # User chose "Yes", indicate to update availability
+                logging.info(f"User chose to update availability for similar item '{suggested_name}' ({size}).")
+                messagebox.showinfo("Information", "Please go to 'Update Availability' to modify this item.")
+                return
+            # No similar item, or the user chose "No": add the item anyway
+            run_in_background(self.frame, lambda: self.save_item(name, size, quantity, price), item_saved,
+                              self.progress, (self.add_button,))
+
+        def item_saved(result):
+            messagebox.showinfo("Success", f"Added new stock item: {name} ({size}).")
+
+        run_in_background(self.frame, find_match, match_found, self.progress, (self.add_button,))
+
+    def save_item(self, name, size, quantity, price):
+        """Add the item to the store, which saves it; runs as a background store job."""
+        from commands import AddItem, command_history_for
+        command = AddItem(name, size, quantity, price)
+        record = command_history_for(self.store).execute(command)
+        old_quantity = None if command.before is None else command.before.quantity
+        audit(f"Added new stock item: {name} ({size}) with quantity {quantity} and price ${price}.",
+              "add_item", name, size, "quantity", old_quantity, record.quantity)
+        return record
 
     def go_back(self):
-        """Close the current window and return to the main menu."""
-        self.root.destroy()
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
         self.main_menu_callback()
 
-    def run(self):
-        """Run the StockManager."""
-        self.root.mainloop()
-
 
 class StockAvailabilityUpdater:
     FILENAME = "stock.csv"
+    TITLE = "Stock Control - Update Quantity"
+    WIDTH, HEIGHT = 400, 340
+    RESIZABLE = True
 
-    def __init__(self, main_menu_callback):
+    def __init__(self, parent, main_menu_callback):
         """Initialize the StockAvailabilityUpdater class."""
         self.main_menu_callback = main_menu_callback
-        self.root = tk.Tk()
-        self.root.title("Stock Control - Update Quantity")
-
-        # Set window size and center it
-        center_window(self.root)
+        self.frame = tk.Frame(parent)
 
-        # Read existing stock data
-        self.stock_items = read_stock_from_csv(self.FILENAME)
-        item_names = list(set(item['name'] for item in self.stock_items))  # Unique item names
-
-        # Dropdown to select stock item
-        tk.Label(self.root, text="Select Item", font=("Arial", 12)).grid(row=0, column=0, padx=10, pady=10, sticky="e")
-        self.item_dropdown = ttk.Combobox(self.root, values=item_names, font=("Arial", 12))
+        # Dropdown to select stock item, filled once the stock is loaded
+        tk.Label(self.frame, text="Select Item", font=("Arial", 12)).grid(row=0, column=0, padx=10, pady=10, sticky="e")
+        self.item_dropdown = ttk.Combobox(self.frame, values=[], font=("Arial", 12))
         self.item_dropdown.grid(row=0, column=1, padx=10, pady=10, sticky="w")
         self.item_dropdown.bind("<<ComboboxSelected>>", self.update_size_dropdown)
 
         # Dropdown to select size
-        tk.Label(self.root, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=10, pady=10, sticky="e")
-        self.size_dropdown = ttk.Combobox(self.root, values=[], font=("Arial", 12))
+        tk.Label(self.frame, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=10, pady=10, sticky="e")
+        self.size_dropdown = ttk.Combobox(self.frame, values=[], font=("Arial", 12))
         self.size_dropdown.grid(row=1, column=1, padx=10, pady=10, sticky="w")
 
         # Dropdown to select operation
-        tk.Label(self.root, text="Operation", font=("Arial", 12)).grid(row=2, column=0, padx=10, pady=10, sticky="e")
+        tk.Label(self.frame, text="Operation", font=("Arial", 12)).grid(row=2, column=0, padx=10, pady=10, sticky="e")
         self.operation_var = tk.StringVar(value="Add Copies")
-        self.operation_dropdown = ttk.Combobox(self.root, textvariable=self.operation_var,
+        self.operation_dropdown = ttk.Combobox(self.frame, textvariable=self.operation_var,
                                                values=["Add Copies", "Sell Copies"], font=("Arial", 12))
         self.operation_dropdown.grid(row=2, column=1, padx=10, pady=10, sticky="w")
 
         # Entry to set quantity
-        tk.Label(self.root, text="Quantity", font=("Arial", 12)).grid(row=3, column=0, padx=10, pady=10, sticky="e")
+        tk.Label(self.frame, text="Quantity", font=("Arial", 12)).grid(row=3, column=0, padx=10, pady=10, sticky="e")
         self.quantity_var = tk.StringVar()
-        tk.Entry(self.root, textvariable=self.quantity_var, font=("Arial", 12)).grid(row=3, column=1, padx=10, pady=10,
-                                                                                     sticky="w")
+        tk.Entry(self.frame, textvariable=self.quantity_var, font=("Arial", 12)).grid(row=3, column=1, padx=10, pady=10,
+                                                                                      sticky="w")
 
         # Button to update quantity
-        tk.Button(self.root, text="Update Quantity", command=self.update_quantity, font=("Arial", 12), width=20).grid(
-            row=4, column=0, columnspan=2, pady=20)
+        self.update_button = tk.Button(self.frame, text="Update Quantity", command=self.update_quantity,
+                                       font=("Arial", 12), width=20, state=tk.DISABLED)
+        self.update_button.grid(row=4, column=0, columnspan=2, pady=20)
 
         # Button to return to main menu
-        tk.Button(self.root, text="Back to Main Menu", command=self.go_back, font=("Arial", 12), width=20).grid(row=5,
-                                                                                                                column=0,
-                                                                                                                columnspan=2,
-                                                                                                                pady=10)
+        tk.Button(self.frame, text="Back to Main Menu", command=self.go_back, font=("Arial", 12), width=20).grid(
+            row=5, column=0, columnspan=2, pady=10)
+
+        # Runs while the stock is loaded or saved in the background
+        self.progress = progress_bar(self.frame)
+        self.progress.grid(row=6, column=0, columnspan=2)
+
+        self.store = None
+        self.catalog = {}  # item name -> sizes, as loaded
+
+    def refresh(self):
+        """Read existing stock data in the background; called each time the screen is shown."""
+        run_in_background(self.frame, lambda: load_stock_catalog(self.FILENAME), self.stock_loaded, self.progress)
+
+    def stock_loaded(self, result):
+        """Fill the item dropdown from the loaded stock and show any error reading it."""
+        self.store, self.catalog, error = result
+        self.item_dropdown.config(values=list(self.catalog))  # Unique item names
+        self.update_button.config(state=tk.NORMAL)
+        if error:
+            messagebox.showerror("Error", error)
 
     def update_size_dropdown(self, event):
         """Update the size dropdown based on the selected item."""
         selected_item = self.item_dropdown.get()
-        sizes = [item['size'] for item in self.stock_items if item['name'] == selected_item]
+        sizes = self.catalog.get(selected_item, [])
         self.size_dropdown.config(values=sizes)
         self.size_dropdown.set("")  # Clear the selection
 
@@ -260,98 +428,113 @@ class StockAvailabilityUpdater:
         quantity = int(self.quantity_var.get().strip())
         operation = self.operation_var.get()
 
-        # Update quantity based on operation
-        updated = False
-        for row in self.stock_items:
-            if row['name'] == item_name and row['size'] == size:
-                current_quantity = int(row['quantity'])
-                if operation == "Add Copies":
-                    new_quantity = current_quantity + quantity
-                    row['quantity'] = str(new_quantity)
-                    # Set availability to 1 if quantity is greater than 0
-                    if new_quantity > 0:
-                        row['availability'] = "1"
-                    logging.info(f"Added {quantity} copies to '{item_name}' ({size}). New quantity: {new_quantity}.")
-                elif operation == "Sell Copies":
-                    if quantity > current_quantity:
-                        messagebox.showerror("Error", "Not enough copies available for this transaction.")
-                        return
-                    new_quantity = current_quantity - quantity
-                    row['quantity'] = str(new_quantity)
-                    # Set availability to 0 if quantity reaches 0
-                    if new_quantity <= 0:
-                        row['quantity'] = "0"
-                        row['availability'] = "0"
-                    logging.info(f"Sold {quantity} copies of '{item_name}' ({size}). New quantity: {new_quantity}.")
-                updated = True
-                break  # Exit loop after updating
-
-        if updated:
-            write_stock_to_csv(self.FILENAME, self.stock_items)
+        def quantity_saved(result):
+            if result is None:
+                messagebox.showwarning("Warning", "Selected item and size not found or no updates made.")
+                return
+            new_quantity, low_threshold = result
             messagebox.showinfo("Success", f"Updated quantity for {item_name} ({size}).")
+            if low_threshold is not None:
+                messagebox.showwarning("Low Stock", f"{item_name} ({size}) is down to {new_quantity} copies, at or "
+                                                    f"below its reorder threshold of {low_threshold}.")
+
+        run_in_background(self.frame, lambda: self.save_quantity(item_name, size, quantity, operation),
+                          quantity_saved, self.progress, (self.update_button,))
+
+    def save_quantity(self, item_name, size, quantity, operation):
+        """Add or sell copies and return (new quantity, reorder threshold if the item is now low) or None.
+
+        Runs as a background store job; None means the item and size are not stocked.
+        """
+        if not self.store.exists(item_name, size):
+            return None
+
+        # Update quantity based on operation
+        from commands import AddCopies, SellCopies, command_history_for
+        commands = command_history_for(self.store)
+        if operation == "Add Copies":
+            command = AddCopies(item_name, size, quantity)
+            new_quantity = commands.execute(command)
+            audit(f"Added {quantity} copies to '{item_name}' ({size}). New quantity: {new_quantity}.",
+                  "add_copies", item_name, size, "quantity", command.before.quantity, new_quantity, delta=quantity)
         else:
-            messagebox.showwarning("Warning", "Selected item and size not found or no updates made.")
+            command = SellCopies(item_name, size, quantity)
+            new_quantity = commands.execute(command)
+            audit(f"Sold {quantity} copies of '{item_name}' ({size}). New quantity: {new_quantity}.",
+                  "sell_copies", item_name, size, "quantity", command.before.quantity, new_quantity,
+                  delta=-quantity)
+
+        from alerts import alerts_for
+        alerts = alerts_for(self.store)
+        if operation == "Sell Copies" and alerts.is_low(item_name, size):
+            return new_quantity, alerts.threshold_for(item_name, size)
+        return new_quantity, None
 
     def go_back(self):
-        """Close the current window and return to the main menu."""
-        self.root.destroy()
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
         self.main_menu_callback()
 
-    def run(self):
-        """Run the StockAvailabilityUpdater."""
-        self.root.mainloop()
-
 
 class StockPriceUpdater:
     FILENAME = "stock.csv"
+    TITLE = "Stock Control - Update Price"
+    WIDTH, HEIGHT = 400, 290
+    RESIZABLE = False
 
-    def __init__(self, main_menu_callback):
+    def __init__(self, parent, main_menu_callback):
         """Initialize the StockPriceUpdater class."""
         self.main_menu_callback = main_menu_callback
-        self.root = tk.Tk()
-        self.root.title("Stock Control - Update Price")
-
-        # Set window size and center it
-        center_window(self.root, width=400, height=250)
-        self.root.resizable(False, False)
+        self.frame = tk.Frame(parent)
 
-        # Read existing stock data
-        self.stock_items = read_stock_from_csv(self.FILENAME)
-        item_names = list(set(item['name'] for item in self.stock_items))  # Unique item names
-
-        # Dropdown to select stock item
-        tk.Label(self.root, text="Select Item", font=("Arial", 12)).grid(row=0, column=0, padx=10, pady=10, sticky="e")
-        self.item_dropdown = ttk.Combobox(self.root, values=item_names, font=("Arial", 12))
+        # Dropdown to select stock item, filled once the stock is loaded
+        tk.Label(self.frame, text="Select Item", font=("Arial", 12)).grid(row=0, column=0, padx=10, pady=10, sticky="e")
+        self.item_dropdown = ttk.Combobox(self.frame, values=[], font=("Arial", 12))
         self.item_dropdown.grid(row=0, column=1, padx=10, pady=10, sticky="w")
         self.item_dropdown.bind("<<ComboboxSelected>>", self.update_size_dropdown)
 
         # Dropdown to select size
-        tk.Label(self.root, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=10, pady=10, sticky="e")
-        self.size_dropdown = ttk.Combobox(self.root, values=[], font=("Arial", 12))
+        tk.Label(self.frame, text="Select Size", font=("Arial", 12)).grid(row=1, column=0, padx=10, pady=10, sticky="e")
+        self.size_dropdown = ttk.Combobox(self.frame, values=[], font=("Arial", 12))
         self.size_dropdown.grid(row=1, column=1, padx=10, pady=10, sticky="w")
 
         # Entry to set new price
-        tk.Label(self.root, text="New Price", font=("Arial", 12)).grid(row=2, column=0, padx=10, pady=10, sticky="e")
+        tk.Label(self.frame, text="New Price", font=("Arial", 12)).grid(row=2, column=0, padx=10, pady=10, sticky="e")
         self.price_var = tk.StringVar()
-        tk.Entry(self.root, textvariable=self.price_var, font=("Arial", 12)).grid(row=2, column=1, padx=10, pady=10,
-                                                                                  sticky="w")
+        tk.Entry(self.frame, textvariable=self.price_var, font=("Arial", 12)).grid(row=2, column=1, padx=10, pady=10,
+                                                                                   sticky="w")
 
         # Button to update price
-        tk.Button(self.root, text="Update Price", command=self.update_price, font=("Arial", 12), width=20).grid(row=3,
-                                                                                                                column=0,
-                                                                                                                columnspan=2,
-                                                                                                                pady=20)
+        self.update_button = tk.Button(self.frame, text="Update Price", command=self.update_price, font=("Arial", 12),
+                                       width=20, state=tk.DISABLED)
+        self.update_button.grid(row=3, column=0, columnspan=2, pady=20)
 
         # Button to return to main menu
-        tk.Button(self.root, text="Back to Main Menu", command=self.go_back, font=("Arial", 12), width=20).grid(row=4,
-                                                                                                                column=0,
-                                                                                                                columnspan=2,
-                                                                                                                pady=10)
+        tk.Button(self.frame, text="Back to Main Menu", command=self.go_back, font=("Arial", 12), width=20).grid(
+            row=4, column=0, columnspan=2, pady=10)
+
+        # Runs while the stock is loaded or saved in the background
+        self.progress = progress_bar(self.frame)
+        self.progress.grid(row=5, column=0, columnspan=2)
+
+        self.store = None
+        self.catalog = {}  # item name -> sizes, as loaded
+
+    def refresh(self):
+        """Read existing stock data in the background; called each time the screen is shown."""
+        run_in_background(self.frame, lambda: load_stock_catalog(self.FILENAME), self.stock_loaded, self.progress)
+
+    def stock_loaded(self, result):
+        """Fill the item dropdown from the loaded stock and show any error reading it."""
+        self.store, self.catalog, error = result
+        self.item_dropdown.config(values=list(self.catalog))  # Unique item names
+        self.update_button.config(state=tk.NORMAL)
+        if error:
+            messagebox.showerror("Error", error)
 
     def update_size_dropdown(self, event):
         """Update the size dropdown based on the selected item."""
         selected_item = self.item_dropdown.get()
-        sizes = [item['size'] for item in self.stock_items if item['name'] == selected_item]
+        sizes = self.catalog.get(selected_item, [])
         self.size_dropdown.config(values=sizes)
         self.size_dropdown.set("")  # Clear the selection
 
@@ -365,8 +548,8 @@ class StockPriceUpdater:
             return False, "No item selected."
         if not size:
             return False, "No size selected."
-        if not price or not price.replace('.', '', 1).isdigit() or float(price) <= 0:
-            return False, "Price must be a positive number."
+        if not is_valid_price(price):
+            return False, "Price must be a positive number with at most two decimals."
 
         return True, ""
 
@@ -381,42 +564,47 @@ class StockPriceUpdater:
         size = self.size_dropdown.get()
         new_price = float(self.price_var.get().strip())
 
-        # Update price for the selected item and size
-        updated = False
-        for row in self.stock_items:
-            if row['name'] == item_name and row['size'] == size:
-                row['price'] = str(new_price)
-                updated = True
-                logging.info(f"Updated price for '{item_name}' ({size}) to ${new_price}.")
-                break  # Exit loop after updating
-
-        if updated:
-            write_stock_to_csv(self.FILENAME, self.stock_items)
+        def price_saved(saved):
+            if not saved:
+                messagebox.showwarning("Warning", "Selected item and size not found or no updates made.")
+                return
             messagebox.showinfo("Success", f"Updated price for {item_name} ({size}).")
-        else:
-            messagebox.showwarning("Warning", "Selected item and size not found or no updates made.")
+
+        run_in_background(self.frame, lambda: self.save_price(item_name, size, new_price), price_saved,
+                          self.progress, (self.update_button,))
+
+    def save_price(self, item_name, size, new_price):
+        """Set the price and return whether the item and size were found; runs as a background store job."""
+        # Update price for the selected item and size
+        if not self.store.exists(item_name, size):
+            return False
+
+        from commands import SetPrice, command_history_for
+        command = SetPrice(item_name, size, new_price)
+        command_history_for(self.store).execute(command)
+        old_price = command.before.price
+        audit(f"Updated price for '{item_name}' ({size}) to ${new_price}.",
+              "set_price", item_name, size, "price", old_price, new_price, delta=round(new_price - old_price, 2))
+        return True
 
     def go_back(self):
-        """Close the current window and return to the main menu."""
-        self.root.destroy()
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
         self.main_menu_callback()
 
-    def run(self):
-        """Run the StockPriceUpdater."""
-        self.root.mainloop()
-
 
 class StockViewer:
     FILENAME = "stock.csv"
+    TITLE = "Stock Control - View Available Items"
+    WIDTH, HEIGHT = None, None  # Sized to fit the table
+    RESIZABLE = True
 
-    def __init__(self, main_menu_callback):
+    def __init__(self, parent, main_menu_callback):
         """Initialize the StockViewer class."""
         self.main_menu_callback = main_menu_callback
-        self.root = tk.Tk()
-        self.root.title("Stock Control - View Available Items")
+        self.frame = tk.Frame(parent)
 
         # Frame for the main content
-        content_frame = tk.Frame(self.root, padx=10, pady=10)
+        content_frame = tk.Frame(self.frame, padx=10, pady=10)
         content_frame.pack(expand=True, fill=tk.BOTH)
 
         # Header Label
@@ -429,142 +617,614 @@ class StockViewer:
         self.search_var = tk.StringVar()
         self.search_entry = tk.Entry(search_frame, textvariable=self.search_var, font=("Helvetica", 12))
         self.search_entry.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+        self.search_entry.bind("<Return>", lambda event: self.search_stock())
+        self.search_var.trace_add("write", self.schedule_search)
+        self.pending_search = None
         tk.Button(search_frame, text="Search", command=self.search_stock, font=("Helvetica", 12)).pack(side=tk.RIGHT)
 
-        # ScrolledText for displaying items
-        self.text_area = scrolledtext.ScrolledText(content_frame, wrap=tk.WORD, width=80, height=20,
-                                                   font=("Helvetica", 12))
-        self.text_area.pack(expand=True, fill=tk.BOTH)
-
-        # Undo functionality
-        self.undo_button = tk.Button(content_frame, text="Undo", command=self.undo, font=("Helvetica", 12))
-        self.undo_button.pack(pady=10)
+        # Table for displaying items, filled one page at a time as it is scrolled
+        table_frame = tk.Frame(content_frame)
+        table_frame.pack(expand=True, fill=tk.BOTH)
+        columns = ("name", "quantity", "price", "size")
+        self.table = ttk.Treeview(table_frame, columns=columns, show="headings", height=20)
+        for column, width in zip(columns, (320, 120, 120, 80)):
+            self.table.heading(column, text=column.capitalize())
+            self.table.column(column, width=width, anchor=tk.W)
+        self.scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.table.yview)
+        self.table.configure(yscrollcommand=self.on_table_scroll)
+        self.table.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.pending_rows = iter(())
+        self.loading_page = False
+
+        # Undo and redo the changes made in this session
+        history_frame = tk.Frame(content_frame)
+        history_frame.pack(pady=10)
+        self.undo_button = tk.Button(history_frame, text="Undo", command=self.undo, font=("Helvetica", 12))
+        self.undo_button.pack(side=tk.LEFT, padx=5)
+        self.redo_button = tk.Button(history_frame, text="Redo", command=self.redo, font=("Helvetica", 12))
+        self.redo_button.pack(side=tk.LEFT, padx=5)
 
         # Back to Main Menu Button
         tk.Button(content_frame, text="Back to Main Menu", command=self.go_back, font=("Helvetica", 12)).pack(pady=10)
 
-        # Undo history
-        self.undo_history = []
+        # Runs while items are read, searched or saved in the background
+        self.progress = progress_bar(content_frame)
+        self.progress.pack()
 
-        # Load and display stock data
-        self.display_stock()
+    def refresh(self):
+        """Load and display stock data; called each time the screen is shown."""
+        self.refresh_table()
 
     def read_stock(self):
-        """Read stock from the CSV file."""
-        stock_list = []
-        try:
-            with open(self.FILENAME, mode='r') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    stock_list.append(row)
-        except FileNotFoundError:
-            messagebox.showerror("Error", "Stock file not found.")
-        return stock_list
+        """Read stock from the CSV file; runs as a background store job."""
+        store, error = load_stock(self.FILENAME)
+        if error:
+            raise StockError(error)
+        return store
+
+    def schedule_search(self, *args):
+        """Search once typing pauses, so fast typing does not run a search per keystroke."""
+        if self.pending_search is not None:
+            self.frame.after_cancel(self.pending_search)
+        self.pending_search = self.frame.after(SEARCH_DEBOUNCE_MS, self.search_stock)
 
     def search_stock(self):
         """Filter and display stock items based on search query."""
-        search_term = self.search_var.get().strip().lower()
-        stock_items = self.read_stock()
-        filtered_items = [item for item in stock_items if search_term in item['name'].lower()]
+        self.pending_search = None
+        search_term = self.search_var.get().strip()
 
-        if not filtered_items:
-            self.text_area.delete(1.0, tk.END)
-            self.text_area.insert(tk.END, "No matching items found.\n")
-            return
+        def matching_items():
+            # Load the stock once, so later keystrokes search the index instead of reading the file again
+            from search_index import index_for
+            store = self.read_stock()
+            return (store.get(name, size) for name in index_for(store).search(search_term)
+                    for size in store.sizes(name))
 
-        self.text_area.delete(1.0, tk.END)
-        for item in filtered_items:
-            display_text = (f"Name: {item['name']}\nQuantity: {item['quantity']}\nPrice: ${item['price']}\n"
-                            f"Size: {item['size']}\n")
-            display_text += "-" * 40 + "\n"
-            self.text_area.insert(tk.END, display_text)
+        self.show_items(matching_items, "No matching items found.")
 
     def display_stock(self):
-        """Display available stock items in the text area."""
-        available_items = [item for item in self.read_stock() if item['availability'] == "1"]
-
-        if not available_items:
-            self.text_area.insert(tk.END, "No available items in stock.\n")
+        """Display available stock items in the table."""
+        self.show_items(lambda: iter_stock(self.FILENAME, available_only=True), "No available items in stock.")
+
+    def show_items(self, items_job, empty_message):
+        """Replace the table contents with the first page of items; the rest load on scroll.
+
+        items_job returns the items and, like reading the pages, runs as a background store job.
+        """
+        def first_page():
+            items = iter(items_job())
+            return items, self.read_page(items)
+
+        def page_read(result):
+            # Searches run in the order they were typed, so the last one to finish is the latest
+            self.pending_rows, page = result
+            self.table.delete(*self.table.get_children())
+            self.add_rows(page)
+            if not page:
+                self.table.insert("", tk.END, values=(empty_message, "", "", ""))
+
+        run_in_background(self.frame, first_page, page_read, self.progress)
+
+    @staticmethod
+    def read_page(items):
+        """Return the table values of the next page of items; runs as a background store job.
+
+        The values are copied here, since the records themselves keep changing on the store thread. An item
+        removed since the search found it comes back as None and is skipped.
+        """
+        return [(item.name, item.quantity, f"${item.price_text}", item.size)
+                for item in itertools.islice(items, VIEWER_PAGE_SIZE) if item is not None]
+
+    def add_rows(self, page):
+        """Add a page of table values to the table."""
+        for values in page:
+            self.table.insert("", tk.END, values=values)
+
+    def load_page(self):
+        """Read the next page of pending items in the background and add it to the table."""
+        if self.loading_page:
             return
+        self.loading_page = True
+        rows = self.pending_rows
+
+        def page_read(page):
+            self.loading_page = False
+            if rows is self.pending_rows:  # Not replaced by a newer search meanwhile
+                self.add_rows(page)
+
+        run_in_background(self.frame, lambda: self.read_page(rows), page_read)
 
-        self.text_area.delete(1.0, tk.END)
-        for item in available_items:
-            display_text = (f"Name: {item['name']}\nQuantity: {item['quantity']}\nPrice: ${item['price']}\n"
-                            f"Size: {item['size']}\n")
-            display_text += "-" * 40 + "\n"
-            self.text_area.insert(tk.END, display_text)
+    def on_table_scroll(self, first, last):
+        """Keep the scrollbar in sync and fetch another page when the bottom comes into view."""
+        self.scrollbar.set(first, last)
+        if float(last) >= 0.9:
+            self.frame.after_idle(self.load_page)
 
     def undo(self):
         """Undo the last action."""
-        if not self.undo_history:
-            messagebox.showinfo("Info", "No actions to undo.")
+        def undo_change():
+            from commands import command_history_for
+            commands = command_history_for(self.read_stock())
+            if not commands.can_undo():
+                return None
+            description, record = commands.undo()
+            self.log_change("undo", f"Undone action: {description}", commands.redo_stack[-1])
+            return description
+
+        def change_undone(description):
+            if description is None:
+                messagebox.showinfo("Info", "No actions to undo.")
+                return
+            self.refresh_table()
+            messagebox.showinfo("Undo", f"Undone action: {description}")
+
+        run_in_background(self.frame, undo_change, change_undone, self.progress, (self.undo_button, self.redo_button))
+
+    def redo(self):
+        """Redo the last undone action."""
+        def redo_change():
+            from commands import command_history_for
+            commands = command_history_for(self.read_stock())
+            if not commands.can_redo():
+                return None
+            description, record = commands.redo()
+            self.log_change("redo", f"Redone action: {description}", commands.undo_stack[-1])
+            return description
+
+        def change_redone(description):
+            if description is None:
+                messagebox.showinfo("Info", "No actions to redo.")
+                return
+            self.refresh_table()
+            messagebox.showinfo("Redo", f"Redone action: {description}")
+
+        run_in_background(self.frame, redo_change, change_redone, self.progress, (self.undo_button, self.redo_button))
+
+    def refresh_table(self):
+        """Show the current search results, or every available item when nothing is searched for."""
+        if self.search_var.get().strip():
+            self.search_stock()
+        else:
+            self.display_stock()
+
+    def log_change(self, operation, message, command):
+        """Log the quantity or price change made by undoing or redoing a command."""
+        old, new = command.replaced, command.state
+        if old is not None and new is not None and old.price_cents != new.price_cents:
+            audit(message, operation, command.name, command.size, "price", old.price, new.price,
+                  delta=round(new.price - old.price, 2))
+            if old.quantity == new.quantity:
+                return
+        old_quantity = None if old is None else old.quantity
+        new_quantity = None if new is None else new.quantity
+        audit(message, operation, command.name, command.size, "quantity", old_quantity, new_quantity,
+              delta=(new_quantity or 0) - (old_quantity or 0))
+
+    def go_back(self):
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
+        self.main_menu_callback()
+
+
+class StockReports:
+    FILENAME = "stock.csv"
+    TITLE = "Stock Control - Reports"
+    WIDTH, HEIGHT = 600, 580
+    RESIZABLE = True
+
+    def __init__(self, parent, main_menu_callback):
+        """Initialize the StockReports class."""
+        self.main_menu_callback = main_menu_callback
+        self.frame = tk.Frame(parent)
+
+        content_frame = tk.Frame(self.frame, padx=10, pady=10)
+        content_frame.pack(expand=True, fill=tk.BOTH)
+
+        # Header and totals, filled in once the report is worked out
+        tk.Label(content_frame, text="Inventory Report", font=("Helvetica", 16, "bold")).pack(pady=5)
+        self.totals_label = tk.Label(content_frame, text="Working out the report...", font=("Helvetica", 12))
+        self.totals_label.pack(pady=5)
+
+        # Units and value per size
+        tk.Label(content_frame, text="By size", font=("Helvetica", 12, "bold")).pack(anchor=tk.W)
+        self.size_table = self.build_table(content_frame, ("size", "units", "value"), height=5)
+
+        # Units and value per item, across all its sizes
+        tk.Label(content_frame, text=f"Top {REPORT_TOP_ITEMS} items by stock value",
+                 font=("Helvetica", 12, "bold")).pack(anchor=tk.W, pady=(10, 0))
+        self.item_table = self.build_table(content_frame, ("item", "units", "value"), height=10)
+
+        # Back to Main Menu Button
+        tk.Button(content_frame, text="Back to Main Menu", command=self.go_back, font=("Helvetica", 12)).pack(pady=10)
+
+        # Runs while the report is worked out in the background
+        self.progress = progress_bar(content_frame)
+        self.progress.pack()
+
+    def refresh(self):
+        """Work out the report in the background; called each time the screen is shown."""
+        run_in_background(self.frame, self.build_report, self.display_report, self.progress)
+
+    def build_report(self):
+        """Load the stock and work out the report; runs as a background store job."""
+        from analytics import inventory_report
+        store, error = load_stock(self.FILENAME)
+        return inventory_report(store), error
+
+    def display_report(self, result):
+        """Show the totals and fill the tables from the report."""
+        report, error = result
+        if error:
+            messagebox.showerror("Error", error)
+        self.totals_label.config(text=f"Total units: {report['total_units']}    "
+                                      f"Total stock value: ${report['total_value'] / 100:,.2f}")
+        self.size_table.delete(*self.size_table.get_children())
+        self.item_table.delete(*self.item_table.get_children())
+        for size, units, value in report['by_size']:
+            self.size_table.insert("", tk.END, values=(size, units, f"${value / 100:,.2f}"))
+        for name, units, value in report['by_name'][:REPORT_TOP_ITEMS]:
+            self.item_table.insert("", tk.END, values=(name, units, f"${value / 100:,.2f}"))
+
+    def build_table(self, parent, columns, height):
+        """Create a table with the given column names."""
+        table = ttk.Treeview(parent, columns=columns, show="headings", height=height)
+        for column in columns:
+            table.heading(column, text=column.capitalize())
+            table.column(column, width=180, anchor=tk.W)
+        table.pack(fill=tk.X, pady=5)
+        return table
+
+    def go_back(self):
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
+        self.main_menu_callback()
+
+
+class StockAlerts:
+    FILENAME = "stock.csv"
+    TITLE = "Stock Control - Low Stock Alerts"
+    WIDTH, HEIGHT = 600, 540
+    RESIZABLE = True
+
+    def __init__(self, parent, main_menu_callback):
+        """Initialize the StockAlerts class."""
+        self.main_menu_callback = main_menu_callback
+        self.frame = tk.Frame(parent)
+
+        self.store = None
+        self.alerts = None
+        self.catalog = {}  # item name -> sizes, as loaded
+
+        content_frame = tk.Frame(self.frame, padx=10, pady=10)
+        content_frame.pack(expand=True, fill=tk.BOTH)
+
+        # Header Label
+        tk.Label(content_frame, text="Low Stock Alerts", font=("Helvetica", 16, "bold")).pack(pady=5)
+
+        # Items at or near their reorder threshold, most urgent first
+        columns = ("status", "name", "size", "quantity", "threshold")
+        self.table = ttk.Treeview(content_frame, columns=columns, show="headings", height=12)
+        for column, width in zip(columns, (90, 240, 60, 90, 90)):
+            self.table.heading(column, text=column.capitalize())
+            self.table.column(column, width=width, anchor=tk.W)
+        self.table.pack(expand=True, fill=tk.BOTH)
+
+        # Form to set a reorder threshold; leaving the size empty sets it for every size of the item
+        form_frame = tk.Frame(content_frame)
+        form_frame.pack(pady=10)
+        tk.Label(form_frame, text="Item", font=("Helvetica", 12)).grid(row=0, column=0, padx=5)
+        self.item_dropdown = ttk.Combobox(form_frame, values=[], font=("Helvetica", 12), width=18)
+        self.item_dropdown.grid(row=0, column=1, padx=5)
+        self.item_dropdown.bind("<<ComboboxSelected>>", self.update_size_dropdown)
+        tk.Label(form_frame, text="Size", font=("Helvetica", 12)).grid(row=0, column=2, padx=5)
+        self.size_dropdown = ttk.Combobox(form_frame, values=[], font=("Helvetica", 12), width=5)
+        self.size_dropdown.grid(row=0, column=3, padx=5)
+        tk.Label(form_frame, text="Threshold", font=("Helvetica", 12)).grid(row=1, column=0, padx=5, pady=10)
+        self.threshold_var = tk.StringVar()
+        tk.Entry(form_frame, textvariable=self.threshold_var, font=("Helvetica", 12), width=8).grid(row=1, column=1,
+                                                                                                  sticky="w", padx=5)
+        self.threshold_button = tk.Button(form_frame, text="Set Threshold", command=self.set_threshold,
+                                          font=("Helvetica", 12), state=tk.DISABLED)
+        self.threshold_button.grid(row=1, column=2, columnspan=2, padx=5)
+
+        # Back to Main Menu Button
+        tk.Button(content_frame, text="Back to Main Menu", command=self.go_back, font=("Helvetica", 12)).pack(pady=10)
+
+        # Runs while the stock is loaded or the thresholds saved in the background
+        self.progress = progress_bar(content_frame)
+        self.progress.pack()
+
+    def refresh(self):
+        """Load the stock and its alerts in the background; called each time the screen is shown."""
+        run_in_background(self.frame, self.load_alerts, self.alerts_loaded, self.progress)
+
+    def load_alerts(self):
+        """Load the stock and its alerts; runs as a background store job."""
+        from alerts import alerts_for
+        store, catalog, error = load_stock_catalog(self.FILENAME)
+        alerts = alerts_for(store)
+        return store, alerts, alerts.entries(), catalog, error
+
+    def alerts_loaded(self, result):
+        """Fill the item dropdown and the alerts table and show any error reading the stock."""
+        self.store, self.alerts, entries, self.catalog, error = result
+        self.item_dropdown.config(values=list(self.catalog))
+        self.threshold_button.config(state=tk.NORMAL)
+        self.display_alerts(entries)
+        if error:
+            messagebox.showerror("Error", error)
+
+    def display_alerts(self, entries):
+        """Show the items at or near their reorder threshold."""
+        self.table.delete(*self.table.get_children())
+        for name, size, quantity, threshold, needs_reorder in entries:
+            status = "Reorder" if needs_reorder else "Low"
+            self.table.insert("", tk.END, values=(status, name, size, quantity, threshold))
+
+    def update_size_dropdown(self, event):
+        """Update the size dropdown based on the selected item."""
+        self.size_dropdown.config(values=self.catalog.get(self.item_dropdown.get(), []))
+        self.size_dropdown.set("")  # Clear the selection
+
+    def set_threshold(self):
+        """Set the reorder threshold for the selected item and size."""
+        item_name = self.item_dropdown.get()
+        size = self.size_dropdown.get()
+        threshold = self.threshold_var.get().strip()
+
+        if not item_name:
+            messagebox.showerror("Error", "No item selected.")
+            return
+        if not threshold.isdigit():
+            messagebox.showerror("Error", "Threshold must be a whole number.")
             return
 
-        last_action = self.undo_history.pop()
-        # Here you should implement logic to revert the last action.
-        # This depends on how you manage actions and state.
+        def save_threshold():
+            # The alerts are kept up to date by store changes, so they are changed on the store thread too
+            from alerts import write_thresholds, THRESHOLDS_FILENAME
+            self.alerts.set_threshold(item_name, size, int(threshold))
+            write_thresholds(THRESHOLDS_FILENAME, self.alerts.thresholds)
+            logging.info(f"Set reorder threshold for '{item_name}' ({size or 'all sizes'}) to {threshold}.")
+            return self.alerts.entries()
 
-        messagebox.showinfo("Undo", f"Undone action: {last_action}")
+        run_in_background(self.frame, save_threshold, self.display_alerts, self.progress, (self.threshold_button,))
 
     def go_back(self):
-        """Close the current window and return to the main menu."""
-        self.root.destroy()
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
         self.main_menu_callback()
 
-    def run(self):
-        """Run the StockViewer."""
-        self.root.mainloop()
 
+class StockTrends:
+    FILENAME = "stock.csv"
+    TITLE = "Stock Control - Stock Trends"
+    WIDTH, HEIGHT = 640, 540
+    RESIZABLE = True
+    METRICS = {"Stock level": 1, "Price": 2, "Units added": 3, "Units sold": 4}
+
+    def __init__(self, parent, main_menu_callback):
+        """Initialize the StockTrends class."""
+        from history import PERIODS
+        self.main_menu_callback = main_menu_callback
+        self.frame = tk.Frame(parent)
 
-def main_menu():
-    """Main program to choose between adding stock, updating stock, and viewing available items."""
+        self.store = None
+        self.history = None
+        self.catalog = {}  # item name -> sizes, as loaded
+
+        content_frame = tk.Frame(self.frame, padx=10, pady=10)
+        content_frame.pack(expand=True, fill=tk.BOTH)
+
+        # Header Label
+        tk.Label(content_frame, text="Stock Trends", font=("Helvetica", 16, "bold")).pack(pady=5)
+
+        # Item, size, period and what to chart
+        form_frame = tk.Frame(content_frame)
+        form_frame.pack(pady=5)
+        tk.Label(form_frame, text="Item", font=("Helvetica", 12)).grid(row=0, column=0, padx=5)
+        self.item_dropdown = ttk.Combobox(form_frame, values=[], font=("Helvetica", 12), width=18)
+        self.item_dropdown.grid(row=0, column=1, padx=5)
+        self.item_dropdown.bind("<<ComboboxSelected>>", self.update_size_dropdown)
+        tk.Label(form_frame, text="Size", font=("Helvetica", 12)).grid(row=0, column=2, padx=5)
+        self.size_dropdown = ttk.Combobox(form_frame, values=[], font=("Helvetica", 12), width=5)
+        self.size_dropdown.grid(row=0, column=3, padx=5)
+        self.size_dropdown.bind("<<ComboboxSelected>>", self.draw_chart)
+        tk.Label(form_frame, text="Period", font=("Helvetica", 12)).grid(row=1, column=0, padx=5, pady=5)
+        self.period_dropdown = ttk.Combobox(form_frame, values=list(PERIODS), state="readonly",
+                                            font=("Helvetica", 12), width=8)
+        self.period_dropdown.set("day")
+        self.period_dropdown.grid(row=1, column=1, sticky="w", padx=5)
+        self.period_dropdown.bind("<<ComboboxSelected>>", self.draw_chart)
+        tk.Label(form_frame, text="Show", font=("Helvetica", 12)).grid(row=1, column=2, padx=5)
+        self.metric_dropdown = ttk.Combobox(form_frame, values=list(self.METRICS), state="readonly",
+                                            font=("Helvetica", 12), width=12)
+        self.metric_dropdown.set("Stock level")
+        self.metric_dropdown.grid(row=1, column=3, padx=5)
+        self.metric_dropdown.bind("<<ComboboxSelected>>", self.draw_chart)
+
+        # Bar chart of the chosen metric, one bar per hour, day or week
+        self.canvas = tk.Canvas(content_frame, width=600, height=320, bg="white")
+        self.canvas.pack(pady=10)
+
+        # Back to Main Menu Button
+        tk.Button(content_frame, text="Back to Main Menu", command=self.go_back, font=("Helvetica", 12)).pack(pady=5)
+
+        # Runs while the stock and its history are loaded or queried in the background
+        self.progress = progress_bar(content_frame)
+        self.progress.pack()
+
+    def refresh(self):
+        """Load the stock and its history in the background; called each time the screen is shown."""
+        run_in_background(self.frame, self.load_history, self.history_loaded, self.progress)
+
+    def load_history(self):
+        """Load the stock and its history; runs as a background store job."""
+        from history import record_history
+        store, catalog, error = load_stock_catalog(self.FILENAME)
+        return store, record_history(store), catalog, error
+
+    def history_loaded(self, result):
+        """Fill the item dropdown, redraw the chart shown and show any error reading the stock."""
+        self.store, self.history, self.catalog, error = result
+        self.item_dropdown.config(values=list(self.catalog))
+        if error:
+            messagebox.showerror("Error", error)
+        self.draw_chart()
+
+    def update_size_dropdown(self, event):
+        """Update the size dropdown based on the selected item."""
+        self.size_dropdown.config(values=self.catalog.get(self.item_dropdown.get(), []))
+        self.size_dropdown.set("")  # Clear the selection
+        self.canvas.delete("all")
+
+    def draw_chart(self, event=None):
+        """Query the rollups for the chosen item and period in the background, then draw them."""
+        self.canvas.delete("all")
+        item_name = self.item_dropdown.get()
+        size = self.size_dropdown.get()
+        if not item_name or not size:
+            return
+
+        # The history database is written by store changes, so it is queried on the store thread too
+        period = self.period_dropdown.get()
+        run_in_background(self.frame, lambda: self.history.rollups(item_name, size, period, limit=TREND_BUCKETS),
+                          self.draw_bars, self.progress)
+
+    def draw_bars(self, rows):
+        """Draw the chosen metric from the precomputed rollups."""
+        self.canvas.delete("all")
+        column = self.METRICS[self.metric_dropdown.get()]
+        bars = []
+        last_value = None
+        for row in rows:
+            # Stock level and price carry over from earlier buckets when a change did not record them
+            if row[column] is not None:
+                last_value = row[column]
+            if last_value is not None:
+                bars.append((row[0], last_value / 100 if column == 2 else last_value))
+        if not bars:
+            self.canvas.create_text(300, 160, text="No changes recorded for this item yet.", font=("Helvetica", 12))
+            return
 
-    def open_add_stock():
-        main_menu_window.destroy()
-        manager = StockManager(main_menu)
-        manager.run()
+        width, height, margin = 600, 320, 40
+        highest = max(value for bucket, value in bars) or 1
+        bar_width = (width - 2 * margin) / len(bars)
+        for number, (bucket, value) in enumerate(bars):
+            left = margin + number * bar_width
+            top = height - margin - (height - 2 * margin) * value / highest
+            self.canvas.create_rectangle(left + 2, top, left + bar_width - 2, height - margin, fill="steelblue")
+            if len(bars) <= 12 or number % (len(bars) // 6) == 0:
+                self.canvas.create_text(left + bar_width / 2, height - margin + 12, text=bucket[5:],
+                                        font=("Helvetica", 8))
+        self.canvas.create_line(margin, height - margin, width - margin, height - margin)
+        self.canvas.create_text(margin, margin - 15, anchor=tk.W, font=("Helvetica", 10),
+                                text=f"{self.metric_dropdown.get()}, highest {highest:g}")
 
-    def open_update_availability():
-        main_menu_window.destroy()
-        updater = StockAvailabilityUpdater(main_menu)
-        updater.run()
+    def go_back(self):
+        """Return to the main menu; this screen keeps its state for the next time it is shown."""
+        self.main_menu_callback()
 
-    def open_update_price():
-        main_menu_window.destroy()
-        updater = StockPriceUpdater(main_menu)
-        updater.run()
 
-    def open_view_stock():
-        main_menu_window.destroy()
-        viewer = StockViewer(main_menu)
-        viewer.run()
+class MainMenu:
+    TITLE = "Stock Control - Main Menu"
+    WIDTH, HEIGHT = 400, 480
+    RESIZABLE = False
 
-    # Create the main menu window
-    global main_menu_window
-    main_menu_window = tk.Tk()
-    main_menu_window.title("Stock Control - Main Menu")
+    def __init__(self, parent, open_screen):
+        """Initialize the MainMenu class; open_screen is called with the screen class of the button clicked."""
+        self.frame = tk.Frame(parent)
 
-    # Set window size and center it
-    main_menu_window.geometry("400x300")
-    main_menu_window.resizable(False, False)
-    center_window(main_menu_window)
+        # Create and style the label
+        tk.Label(self.frame, text="Choose an action:", font=("Arial", 14)).pack(pady=20)
 
-    # Create and style the label
-    tk.Label(main_menu_window, text="Choose an action:", font=("Arial", 14)).pack(pady=20)
+        # Create and style buttons
+        button_options = [
+            ("Add Stock", StockManager),
+            ("Update Availability", StockAvailabilityUpdater),
+            ("Update Price", StockPriceUpdater),
+            ("View Available Items", StockViewer),
+            ("Reports", StockReports),
+            ("Low Stock Alerts", StockAlerts),
+            ("Stock Trends", StockTrends)
+        ]
 
-    # Create and style buttons
-    button_options = [
-        ("Add Stock", open_add_stock),
-        ("Update Availability", open_update_availability),
-        ("Update Price", open_update_price),
-        ("View Available Items", open_view_stock)
-    ]
+        for text, screen_class in button_options:
+            tk.Button(self.frame, text=text, command=lambda screen_class=screen_class: open_screen(screen_class),
+                      font=("Arial", 12), width=25).pack(pady=10)
 
-    for text, command in button_options:
-        tk.Button(main_menu_window, text=text, command=command, font=("Arial", 12), width=25).pack(pady=10)
+    def refresh(self):
+        """Nothing to reload; the menu never changes."""
 
-    main_menu_window.mainloop()
+
+class StockApp:
+    """The one window of the program; each screen is a frame in it, built the first time it is opened."""
+
+    def __init__(self):
+        """Create the window and show the main menu."""
+        self.root = tk.Tk()
+        self.screens = {}
+        self.current = None
+        self.menu = MainMenu(self.root, self.open_screen)
+        self.show(self.menu)
+
+    def show(self, screen):
+        """Swap the frame on show for the screen's, with its title and window size."""
+        if self.current is not None:
+            self.current.frame.pack_forget()
+        self.current = screen
+        self.root.title(screen.TITLE)
+        self.root.resizable(screen.RESIZABLE, screen.RESIZABLE)
+        if screen.WIDTH is None:
+            self.root.geometry("")  # Let the window fit the screen's widgets
+        else:
+            center_window(self.root, width=screen.WIDTH, height=screen.HEIGHT)
+        screen.frame.pack(expand=True, fill=tk.BOTH)
+
+    def open_screen(self, screen_class):
+        """Show a screen, building it the first time; each time it is shown it picks up changes made elsewhere."""
+        screen = self.screens.get(screen_class)
+        if screen is None:
+            screen = self.screens[screen_class] = screen_class(self.root, self.show_menu)
+        self.show(screen)
+        screen.refresh()
+
+    def show_menu(self):
+        self.show(self.menu)
+
+    def run(self):
+        """Run the program until the window is closed."""
+        self.root.mainloop()
+
+
+def main_menu(report_startup=False):
+    """Main program to choose between adding stock, updating stock, and viewing available items."""
+    menu_started = time.perf_counter()
+    app = StockApp()
+
+    if report_startup:
+        def report_first_paint(event):
+            # The first Expose event is the menu being drawn on screen
+            app.root.unbind("<Expose>")
+            first_paint = time.perf_counter() - menu_started
+            print(f"Imports: {IMPORT_SECONDS * 1000:.1f} ms")
+            print(f"Main menu first paint: {first_paint * 1000:.1f} ms")
+            print(f"Total: {(IMPORT_SECONDS + first_paint) * 1000:.1f} ms")
+            app.root.destroy()
+
+        app.root.bind("<Expose>", report_first_paint)
+
+    app.run()
 
 
 if __name__ == "__main__":
-    main_menu()
+    parser = argparse.ArgumentParser(description="Stock Control Manager")
+    parser.add_argument("--startup-time", action="store_true",
+                        help="report import and main menu first-paint times, then exit")
+    args = parser.parse_args()
+
+    if args.startup_time:
+        main_menu(report_startup=True)
+    else:
+        try:
+            main_menu()
+        finally:
+            finish_background_jobs()
+            compact_stock(StockManager.FILENAME)
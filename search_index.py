@@ -0,0 +1,77 @@
+import threading
+import weakref
+
+
+def trigrams(text):
+    """Return the set of three-character substrings of a string."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameSearchIndex:
+    """Trigram index over item names for case-insensitive substring search.
+
+    Safe to search from one thread while names are added from another.
+    """
+
+    def __init__(self, names=()):
+        """Build the index from an iterable of item names."""
+        self._lowered = {}  # name -> lowercased name, in insertion order
+        self._order = {}  # name -> insertion position, to return results in stock order
+        self._postings = {}  # trigram -> set of names containing it
+        self._last_term = None
+        self._last_matches = None
+        self._lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._lowered)
+
+    def add(self, name):
+        """Index a name; names that are already indexed are ignored."""
+        with self._lock:
+            if name in self._lowered:
+                return
+            lowered = name.lower()
+            self._lowered[name] = lowered
+            self._order[name] = len(self._order)
+            for gram in trigrams(lowered):
+                self._postings.setdefault(gram, set()).add(name)
+            # A new name may match the previous term, so the next search cannot narrow from it
+            self._last_term = None
+
+    def _candidates(self, term):
+        """Return names that may contain the term, as small a set as the index allows."""
+        if self._last_term is not None and self._last_term in term:
+            # Typing extended the previous term, so only its matches can still match
+            return self._last_matches
+        if len(term) < 3:
+            return self._lowered
+        postings = sorted((self._postings.get(gram, set()) for gram in trigrams(term)), key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates = candidates & posting
+        return candidates
+
+    def search(self, term):
+        """Return the names containing the term, in the order they were indexed."""
+        term = term.lower()
+        with self._lock:
+            matches = {name for name in self._candidates(term) if term in self._lowered[name]}
+            self._last_term, self._last_matches = term, matches
+            return sorted(matches, key=self._order.__getitem__)
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def index_for(store):
+    """Return the search index for a stock store, building it on first use and keeping it current."""
+    index = _indexes.get(store)
+    if index is None:
+        index = NameSearchIndex(store.names())
+        store.subscribe(lambda op, record: index.add(record.name), remote=True)
+        _indexes[store] = index
+    return index
@@ -0,0 +1,200 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+
+from audit_log import audit, setup_logging
+from stock_store import StockError, validate_new_item
+from storage import open_storage
+
+
+# Helper function for streaming records out of a JSON array or a JSON Lines file
+def iter_json_records(file, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for chunk in iter(lambda: file.read(chunk_size), ""):
+        buffer += chunk
+        position = 0
+        while True:
+            # Skip whitespace and the array punctuation between records
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                position += 1
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # Record continues in the next chunk
+            yield record
+        buffer = buffer[position:]
+    if buffer.strip(" \t\r\n,[]"):
+        raise ValueError("File ends in the middle of a JSON record.")
+
+
+def iter_supplier_rows(filename):
+    """Yield (line or record number, row) from a supplier CSV or JSON file, one row at a time."""
+    with open(filename, mode='r', newline='') as file:
+        if filename.lower().endswith((".json", ".jsonl", ".ndjson")):
+            for number, record in enumerate(iter_json_records(file), start=1):
+                yield number, record
+        else:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+
+
+def record_history(store, changes):
+    """Record (name, size, quantity, price_cents, delta) changes in the stock history, as the windows do.
+
+    Called once the stock lock is released, so the tills are not held off while the history is written.
+    """
+    from history import StockHistory
+    timestamp = time.time()
+    history = StockHistory()
+    try:
+        if not history.has_baseline():
+            history.baseline(store, timestamp)
+        history.record_many((timestamp,) + change for change in changes)
+    finally:
+        history.close()
+
+
+def import_stock(storage, filename, strict=False, history=True):
+    """Merge a supplier file into the stock with one write at the end; return (imported, errors).
+
+    Recording the history writes an event and three rollup rows per item, which for a file of many new
+    items takes longer than the import itself; history=False leaves it out.
+    """
+    items = []
+    errors = []
+    for number, row in iter_supplier_rows(filename):
+        name, size, price, quantity = (str(row.get(field, "")).strip()
+                                       for field in ('name', 'size', 'price', 'quantity'))
+        is_valid, message = validate_new_item(name, size, price, quantity)
+        if not is_valid:
+            errors.append(f"{filename}:{number}: {message}")
+            continue
+        items.append((name, size, int(quantity), float(price)))
+
+    if (errors and strict) or not items:
+        return 0, errors
+    # Only the imported rows are written, on top of whatever the tills have saved in the meantime
+    store = storage.load()
+    with storage.transaction(store):
+        added = {}
+        for name, size, quantity, price in items:
+            record = store.add_item(name, size, quantity, price)
+            key = (record.name, record.size)
+            added[key] = (record, added[key][1] + quantity if key in added else quantity)
+        storage.save_changes(store, [record for record, units in added.values()])
+
+    # One history event per item with the units added in total, and one audit line for the whole file
+    if history:
+        record_history(store, ((record.name, record.size, record.quantity, record.price_cents, units)
+                               for record, units in added.values()))
+    units = sum(units for record, units in added.values())
+    audit(f"Bulk imported {len(items)} stock rows ({units} units) from '{filename}'.",
+          "bulk_import", None, None, "quantity", None, None, delta=units)
+    return len(items), errors
+
+
+BATCH_OPERATIONS = {"add": "add", "add copies": "add", "restock": "add", "sell": "sell", "sell copies": "sell"}
+
+
+def read_batch(filename):
+    """Read (name, size, operation, quantity) operations from a CSV file; return (operations, errors)."""
+    operations = []
+    errors = []
+    for number, row in iter_supplier_rows(filename):
+        name, size, operation, quantity = (str(row.get(field, "")).strip()
+                                           for field in ('name', 'size', 'operation', 'quantity'))
+        operation = BATCH_OPERATIONS.get(operation.lower())
+        if not name or not size:
+            errors.append(f"{filename}:{number}: Item name and size are required.")
+        elif operation is None:
+            errors.append(f"{filename}:{number}: Operation must be Add Copies or Sell Copies.")
+        elif not quantity.isdigit() or int(quantity) <= 0:
+            errors.append(f"{filename}:{number}: Quantity must be a positive integer.")
+        else:
+            operations.append((name, size, operation, int(quantity)))
+    return operations, errors
+
+
+def apply_batch_file(storage, filename):
+    """Apply every operation in a batch file atomically with one storage write; return (count, errors)."""
+    operations, errors = read_batch(filename)
+    if errors:
+        return 0, errors
+    store = storage.load()
+    # Checked and applied against the latest rows, with the tills held off until it is saved
+    with storage.transaction(store):
+        quantities = {(name, size): store.get(name, size).quantity
+                      for name, size, operation, quantity in operations if store.exists(name, size)}
+        try:
+            changed = store.apply_batch(operations)
+        except StockError as e:
+            return 0, [f"{filename}: {e} No changes were made."]
+        storage.save_changes(store, changed)
+
+    # Every operation is recorded on its own, with the quantity it left the item at, so a restock and a
+    # sale of the same item are not netted out
+    changes = []
+    for name, size, operation, quantity in operations:
+        old_quantity = quantities[(name, size)]
+        delta = quantity if operation == "add" else -quantity
+        new_quantity = quantities[(name, size)] = old_quantity + delta
+        if operation == "add":
+            audit(f"Added {quantity} copies to '{name}' ({size}). New quantity: {new_quantity}.",
+                  "add_copies", name, size, "quantity", old_quantity, new_quantity, delta=delta)
+        else:
+            audit(f"Sold {quantity} copies of '{name}' ({size}). New quantity: {new_quantity}.",
+                  "sell_copies", name, size, "quantity", old_quantity, new_quantity, delta=delta)
+        changes.append((name, size, new_quantity, None, delta))
+    record_history(store, changes)
+    return len(operations), []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stock Control command-line tools.")
+    parser.add_argument("--backend", choices=["csv", "sqlite"], default="csv", help="storage backend")
+    parser.add_argument("--stock", default="stock.csv", help="CSV stock file")
+    parser.add_argument("--database", default="stock.db", help="SQLite stock database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="bulk import items from a supplier CSV or JSON file")
+    import_parser.add_argument("file", help="CSV with name,size,price,quantity columns, or JSON records")
+    import_parser.add_argument("--strict", action="store_true", help="import nothing if any row is invalid")
+    import_parser.add_argument("--no-history", action="store_true",
+                               help="do not record the import in the stock history (faster for large files; "
+                                    "the trend charts then count the imported units as part of the next change)")
+
+    batch_parser = commands.add_parser("batch", help="apply a point-of-sale export of sales and restocks")
+    batch_parser.add_argument("file", help="CSV with name,size,operation,quantity columns "
+                                           "(operation is Add Copies or Sell Copies)")
+
+    args = parser.parse_args(argv)
+    setup_logging('stock_control.log')
+    storage = open_storage(args.backend, args.stock, args.database)
+
+    if args.command == "import":
+        started = time.perf_counter()
+        imported, errors = import_stock(storage, args.file, strict=args.strict, history=not args.no_history)
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(f"Imported {imported} rows, skipped {len(errors)} invalid rows "
+              f"in {time.perf_counter() - started:.2f} s.")
+        return 1 if errors and args.strict else 0
+
+    if args.command == "batch":
+        applied, errors = apply_batch_file(storage, args.file)
+        for error in errors:
+            print(error, file=sys.stderr)
+        if errors:
+            return 1
+        logging.info(f"Applied batch of {applied} quantity changes from '{args.file}'.")
+        print(f"Applied {applied} operations.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
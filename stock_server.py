@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from audit_log import audit, setup_logging
+from stock_store import StockError, StockStore, is_valid_price, validate_new_item
+from storage import open_storage
+
+# Most search results returned when the request does not ask for fewer
+SEARCH_LIMIT = 100
+
+# Largest request body accepted, in bytes
+MAX_BODY = 64 * 1024
+
+# Longest a read waits for changes saved by other tills to be merged in, in seconds; if another till holds
+# the stock lock for longer, the read is answered from memory and the merge finishes in the background
+REFRESH_TIMEOUT = 0.2
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class ApiError(Exception):
+    """Raised by a handler to answer with an HTTP error status and message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Helper function for the JSON form of a stock record
+def record_json(record):
+    return {'name': record.name, 'size': record.size, 'quantity': record.quantity, 'price': record.price,
+            'available': record.available}
+
+
+# Helper function for reading a field that must be a positive whole number
+def positive_int(body, field):
+    value = str(body.get(field, "")).strip()
+    if not value.isdigit() or int(value) <= 0:
+        raise ApiError(400, f"{field.capitalize()} must be a positive integer.")
+    return int(value)
+
+
+# Helper function for reading the name and size every change is addressed by
+def item_key(body):
+    name = str(body.get('name', "")).strip()
+    size = str(body.get('size', "")).strip()
+    if not name or not size:
+        raise ApiError(400, "Item name and size are required.")
+    return name, size
+
+
+# Helper function for the record a change is made to
+def existing_record(store, name, size):
+    record = store.get(name, size)
+    if record is None:
+        raise ApiError(404, f"Item '{name}' ({size}) not found.")
+    return record
+
+
+class StockWriter:
+    """Runs every change to the store, one batch at a time, on a thread of its own.
+
+    Changes that queue up while one batch is being saved are applied together under one storage
+    transaction, so a burst of sales takes the lock and catches up with other tills once. Waiting for
+    the lock, the disk and the history database happens on the writer thread, never on the event loop.
+    Callers hear about a change only once the whole transaction has been saved.
+    """
+
+    def __init__(self, storage, store):
+        """Initialize the writer; start() must be called from the event loop."""
+        self.storage = storage
+        self.store = store
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stock-writer")
+        self.signature = storage.signature()
+        self.pending_refresh = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def call(self, function, *args):
+        """Run function(*args) on the writer thread and return its result."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def submit(self, change, key=None):
+        """Queue change(store) and return its result once it has been saved.
+
+        change returns (result, write_audit): write_audit is called, if not None, once the change is saved.
+        key is the (name, size) the change is made to, reloaded from disk if saving fails.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((change, key, future))
+        return await future
+
+    async def refresh(self):
+        """Merge in changes saved by other tills since the last change or refresh, waiting at most REFRESH_TIMEOUT."""
+        if self.storage.signature() == self.signature:
+            return
+        if self.pending_refresh is None or self.pending_refresh.done():
+            self.pending_refresh = asyncio.ensure_future(self.submit(lambda store: (None, None)))
+            # A failed merge is logged by the writer; it must not be reported again as never retrieved
+            self.pending_refresh.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            await asyncio.wait_for(asyncio.shield(self.pending_refresh), REFRESH_TIMEOUT)
+        except (asyncio.TimeoutError, ApiError):
+            pass
+
+    def apply(self, changes):
+        """Apply changes under one storage transaction on the writer thread; return one (result, error) each."""
+        outcomes = []
+        with self.store.transaction():
+            for change in changes:
+                try:
+                    outcomes.append((change(self.store), None))
+                except (StockError, ApiError) as e:
+                    # The request fails; the rest of the batch carries on
+                    outcomes.append((None, e))
+        return outcomes
+
+    def reload(self, keys):
+        """Put the rows of a batch that failed to save back to what is on disk; runs on the writer thread."""
+        latest = self.storage.load()
+        for name, size in keys:
+            record = latest.get(name, size)
+            if record is not None:
+                self.store.apply("set", record, notify=True)
+            elif self.store.exists(name, size):
+                self.store.apply("remove", self.store.get(name, size), notify=True)
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                outcomes = await self.call(self.apply, [change for change, key, future in batch])
+            except Exception as e:
+                logging.error(f"Failed to save stock changes: {e}")
+                try:
+                    await self.call(self.reload, {key for change, key, future in batch if key is not None})
+                except Exception as e:
+                    logging.error(f"Failed to reload the stock after a failed save: {e}")
+                for change, key, future in batch:
+                    if not future.done():
+                        future.set_exception(ApiError(500, "Failed to save the stock."))
+            else:
+                for (change, key, future), (outcome, error) in zip(batch, outcomes):
+                    if error is not None:
+                        future.set_exception(error)
+                        continue
+                    result, write_audit = outcome
+                    if write_audit is not None:
+                        write_audit()
+                    if not future.done():
+                        future.set_result(result)
+            self.signature = self.storage.signature()
+
+
+class StockApi:
+    """The stock operations of the windows, as JSON over HTTP."""
+
+    def __init__(self, storage, store):
+        """Initialize the API on an attached store."""
+        self.store = store
+        self.writer = StockWriter(storage, store)
+        self.routes = {
+            ("GET", "/item"): self.lookup,
+            ("GET", "/search"): self.search,
+            ("POST", "/items"): self.add_item,
+            ("POST", "/sell"): self.sell,
+            ("POST", "/restock"): self.restock,
+            ("POST", "/price"): self.set_price,
+        }
+
+    async def lookup(self, query, body):
+        """GET /item?name=...&size=...: one item size."""
+        await self.writer.refresh()
+        name, size = item_key(query)
+        return 200, record_json(existing_record(self.store, name, size))
+
+    async def search(self, query, body):
+        """GET /search?q=...&limit=...: item sizes whose name contains q."""
+        from search_index import index_for
+        await self.writer.refresh()
+        term = str(query.get('q', "")).strip()
+        limit = positive_int(query, 'limit') if 'limit' in query else SEARCH_LIMIT
+
+        def matches():
+            items = []
+            for name in index_for(self.store).search(term):
+                for size in self.store.sizes(name):
+                    items.append(record_json(self.store.get(name, size)))
+                    if len(items) >= limit:
+                        return items
+            return items
+
+        # Read on the writer thread, so a row merged in from another till cannot disappear mid-search
+        return 200, {'items': await self.writer.call(matches)}
+
+    async def add_item(self, query, body):
+        """POST /items {name, size, price, quantity}: add an item, or top up an existing one."""
+        name, size, price, quantity = (str(body.get(field, "")).strip()
+                                       for field in ('name', 'size', 'price', 'quantity'))
+        is_valid, message = validate_new_item(name, size, price, quantity)
+        if not is_valid:
+            raise ApiError(400, message)
+
+        def change(store):
+            existing = store.get(name, size)
+            old_quantity = None if existing is None else existing.quantity
+            record = store.add_item(name, size, int(quantity), float(price))
+            return record_json(record), lambda: audit(
+                f"Added new stock item: {name} ({size}) with quantity {quantity} and price ${float(price)}.",
+                "add_item", name, size, "quantity", old_quantity, record.quantity)
+
+        return 201, await self.writer.submit(change, (name, size))
+
+    async def sell(self, query, body):
+        """POST /sell {name, size, quantity}: sell copies of an item."""
+        from alerts import alerts_for
+        name, size = item_key(body)
+        quantity = positive_int(body, 'quantity')
+
+        def change(store):
+            old_quantity = existing_record(store, name, size).quantity
+            new_quantity = store.sell_copies(name, size, quantity)
+            result = dict(record_json(store.get(name, size)), low_stock=alerts_for(store).is_low(name, size))
+            return result, lambda: audit(
+                f"Sold {quantity} copies of '{name}' ({size}). New quantity: {new_quantity}.",
+                "sell_copies", name, size, "quantity", old_quantity, new_quantity, delta=-quantity)
+
+        return 200, await self.writer.submit(change, (name, size))
+
+    async def restock(self, query, body):
+        """POST /restock {name, size, quantity}: add copies of an item."""
+        name, size = item_key(body)
+        quantity = positive_int(body, 'quantity')
+
+        def change(store):
+            old_quantity = existing_record(store, name, size).quantity
+            new_quantity = store.add_copies(name, size, quantity)
+            return record_json(store.get(name, size)), lambda: audit(
+                f"Added {quantity} copies to '{name}' ({size}). New quantity: {new_quantity}.",
+                "add_copies", name, size, "quantity", old_quantity, new_quantity, delta=quantity)
+
+        return 200, await self.writer.submit(change, (name, size))
+
+    async def set_price(self, query, body):
+        """POST /price {name, size, price}: change the price of an item."""
+        name, size = item_key(body)
+        price = str(body.get('price', "")).strip()
+        if not is_valid_price(price):
+            raise ApiError(400, "Price must be a positive number with at most two decimals.")
+        new_price = float(price)
+
+        def change(store):
+            old_price = existing_record(store, name, size).price
+            record = store.set_price(name, size, new_price)
+            return record_json(record), lambda: audit(
+                f"Updated price for '{name}' ({size}) to ${new_price}.",
+                "set_price", name, size, "price", old_price, new_price, delta=round(new_price - old_price, 2))
+
+        return 200, await self.writer.submit(change, (name, size))
+
+    async def respond(self, method, target, body):
+        """Route one request and return (status, JSON-ready result)."""
+        url = urlsplit(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            if any(path == url.path for _, path in self.routes):
+                return 405, {'error': f"{method} is not supported on {url.path}."}
+            return 404, {'error': f"No such endpoint: {url.path}."}
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if body:
+                body = json.loads(body)
+                if not isinstance(body, dict):
+                    raise ApiError(400, "Request body must be a JSON object.")
+            return await handler(query, body or {})
+        except json.JSONDecodeError:
+            return 400, {'error': "Request body is not valid JSON."}
+        except ApiError as e:
+            return e.status, {'error': str(e)}
+        except StockError as e:
+            return 409, {'error': str(e)}
+        except Exception:
+            logging.exception(f"Failed to handle {method} {target}")
+            return 500, {'error': "Internal server error."}
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests of one keep-alive connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, result = 413, {'error': "Request body is too large."}
+                    keep_alive = False
+                else:
+                    body = (await reader.readexactly(length)).decode('utf-8') if length else ""
+                    status, result = await self.respond(method, target, body)
+                    keep_alive = (headers.get('connection', '').lower() != 'close'
+                                  and version == "HTTP/1.1")
+                payload = json.dumps(result).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                             + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass  # Malformed request or the client went away
+        finally:
+            writer.close()
+
+
+async def serve(api, host, port):
+    # Changes made through the API show up in the Stock Trends charts like the ones made in the windows;
+    # the history database is written as the store changes, so it is opened on the writer thread
+    from history import record_history
+    await api.writer.call(record_history, api.store)
+    api.writer.start()
+    server = await asyncio.start_server(api.handle_connection, host, port)
+    print(f"Stock API listening on http://{host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON API for the stock.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--backend", choices=["csv", "sqlite"], default="csv", help="storage backend")
+    parser.add_argument("--stock", default="stock.csv", help="CSV stock file")
+    parser.add_argument("--database", default="stock.db", help="SQLite stock database")
+    parser.add_argument("--group-commit-ms", type=int, default=None,
+                        help="flush journaled changes to disk together once per this many milliseconds")
+    args = parser.parse_args(argv)
+
+    setup_logging('stock_control.log')
+    storage = open_storage(args.backend, args.stock, args.database, group_commit_ms=args.group_commit_ms)
+    store = storage.attach(StockStore(storage.read_rows()))
+    api = StockApi(storage, store)
+    try:
+        asyncio.run(serve(api, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Let a batch still being saved finish before the journal is folded into the stock file
+        api.writer.executor.shutdown(wait=True)
+        storage.compact()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import sys
+from contextlib import nullcontext
+
+FIELDNAMES = ['name', 'quantity', 'price', 'size', 'availability']
+
+
+class StockError(Exception):
+    """Raised when a stock operation cannot be applied."""
+
+
+def validate_new_item(name, size, price, quantity):
+    """Validate the fields of an item being added; values are the stripped strings the user entered."""
+    if not name:
+        return False, "Item name cannot be empty."
+    if not size:
+        return False, "Size must be selected."
+    if not is_valid_price(price):
+        return False, "Price must be a positive number with at most two decimals."
+    if not quantity.isdigit() or int(quantity) <= 0:
+        return False, "Quantity must be a positive integer."
+
+    return True, ""
+
+
+def is_valid_price(price):
+    """Check that an entered price is a positive number of whole cents, such as "4.5" or "12.99"."""
+    if not price or not price.replace('.', '', 1).isdigit():
+        return False
+    # More decimals would be rounded away when the price is stored in cents, "0.001" down to nothing
+    return len(price.partition('.')[2]) <= 2 and to_cents(price) > 0
+
+
+def to_cents(price):
+    """Convert a price given as a number or numeric string to whole cents."""
+    return round(float(price) * 100)
+
+
+def format_price(cents):
+    """Format a price in cents the way prices have always been written to stock.csv."""
+    return str(cents / 100)
+
+
+class StockRecord:
+    """One stock row: interned name and size, integer quantity, price in cents and an availability flag."""
+    __slots__ = ('name', 'size', 'quantity', 'price_cents', 'available')
+
+    def __init__(self, name, size, quantity, price_cents, available):
+        """Initialize a record from already parsed values."""
+        # Names and sizes repeat across rows, so every row shares one string object for each
+        self.name = sys.intern(name)
+        self.size = sys.intern(size)
+        self.quantity = quantity
+        self.price_cents = price_cents
+        self.available = available
+
+    def __repr__(self):
+        return (f"StockRecord({self.name!r}, {self.size!r}, quantity={self.quantity}, "
+                f"price={self.price_text}, available={self.available})")
+
+    @classmethod
+    def from_csv(cls, row):
+        """Parse a record from a CSV row dict of strings."""
+        return cls(row['name'], row['size'], int(row['quantity']), to_cents(row['price']),
+                   row['availability'] == "1")
+
+    @property
+    def price(self):
+        """Return the price as a float."""
+        return self.price_cents / 100
+
+    @property
+    def price_text(self):
+        """Return the price formatted for display and for the CSV file."""
+        return format_price(self.price_cents)
+
+    def csv_values(self):
+        """Return the CSV column values in FIELDNAMES order."""
+        return [self.name, str(self.quantity), self.price_text, self.size, "1" if self.available else "0"]
+
+    def copy(self):
+        """Return an independent copy of the record."""
+        return StockRecord(self.name, self.size, self.quantity, self.price_cents, self.available)
+
+
+class StockStore:
+    """In-memory stock table indexed by (name, size) and by name."""
+
+    def __init__(self, stock_items=()):
+        """Build the indexes from StockRecords; the records are adopted, not copied."""
+        self.stock_items = []
+        self._by_key = {}
+        self._sizes_by_name = {}
+        self._listeners = []
+        self._remote_listeners = []
+        self._transaction = nullcontext
+        for record in stock_items:
+            existing = self._by_key.get((record.name, record.size))
+            if existing is None:
+                self._insert(record)
+            else:
+                # Duplicate (name, size) rows are folded into the first one so no copies are lost
+                existing.quantity += record.quantity
+                existing.available = existing.available or record.available
+
+    def __iter__(self):
+        return iter(self.stock_items)
+
+    def __len__(self):
+        return len(self.stock_items)
+
+    def _insert(self, record):
+        """Append a record and register it in both indexes."""
+        self.stock_items.append(record)
+        self._by_key[(record.name, record.size)] = record
+        self._sizes_by_name.setdefault(record.name, {})[record.size] = None
+
+    def _remove(self, record):
+        """Drop a record from both indexes."""
+        del self._by_key[(record.name, record.size)]
+        sizes = self._sizes_by_name[record.name]
+        del sizes[record.size]
+        if not sizes:
+            del self._sizes_by_name[record.name]
+        if self.stock_items[-1] is record:
+            # Undo removes the items it added newest first, so this is the usual case
+            self.stock_items.pop()
+        else:
+            self.stock_items.remove(record)
+
+    def subscribe(self, callback, remote=False):
+        """Register a callback(op, record) that is called after every change; op is "set" or "remove".
+
+        A "remove" callback gets the record as it was when it was removed. Callbacks registered with
+        remote=True, such as indexes, are also called for changes merged in from other processes;
+        the others, such as storage, only see changes made through this store.
+        """
+        self._listeners.append(callback)
+        if remote:
+            self._remote_listeners.append(callback)
+
+    def _notify(self, op, record, remote=False):
+        for callback in self._remote_listeners if remote else self._listeners:
+            callback(op, record)
+
+    def set_transaction(self, transaction):
+        """Use a storage's transaction() for changes, so each one is made on up-to-date rows."""
+        self._transaction = transaction
+
+    def transaction(self):
+        """Return a context manager that holds the storage lock with the store brought up to date."""
+        return self._transaction()
+
+    def apply(self, op, record, notify=False):
+        """Apply a recorded change, notifying only the remote listeners if notify is set."""
+        existing = self._by_key.get((record.name, record.size))
+        if op == "set":
+            if existing is None:
+                existing = record.copy()
+                self._insert(existing)
+            else:
+                existing.quantity = record.quantity
+                existing.price_cents = record.price_cents
+                existing.available = record.available
+        elif op == "remove":
+            if existing is None:
+                return
+            self._remove(existing)
+        if notify:
+            self._notify(op, existing, remote=True)
+
+    def replace_all(self, stock_items):
+        """Bring the store in line with a freshly read stock, keeping this store object and its indexes."""
+        latest = StockStore(stock_items)
+        for record in list(self.stock_items):
+            if not latest.exists(record.name, record.size):
+                self.apply("remove", record, notify=True)
+        for record in latest:
+            existing = self._by_key.get((record.name, record.size))
+            if (existing is None or existing.quantity != record.quantity
+                    or existing.price_cents != record.price_cents or existing.available != record.available):
+                self.apply("set", record, notify=True)
+
+    def get(self, name, size):
+        """Return the record for (name, size), or None if there is none."""
+        return self._by_key.get((name, size))
+
+    def exists(self, name, size):
+        """Check if an item with the given name and size exists."""
+        return (name, size) in self._by_key
+
+    def names(self):
+        """Return the unique item names."""
+        return list(self._sizes_by_name)
+
+    def sizes(self, name):
+        """Return the sizes stocked for an item name."""
+        return list(self._sizes_by_name.get(name, ()))
+
+    def _require(self, name, size):
+        record = self._by_key.get((name, size))
+        if record is None:
+            raise StockError("Selected item and size not found or no updates made.")
+        return record
+
+    def add_item(self, name, size, quantity, price):
+        """Add a new item, or top up the existing record if (name, size) is already stocked."""
+        record = self._by_key.get((name, size))
+        if record is None:
+            record = StockRecord(name, size, quantity, to_cents(price), quantity > 0)
+            self._insert(record)
+            self._notify("set", record)
+            return record
+
+        record.quantity += quantity
+        record.price_cents = to_cents(price)
+        if record.quantity > 0:
+            record.available = True
+        self._notify("set", record)
+        return record
+
+    def add_copies(self, name, size, quantity):
+        """Add copies to an item and return its new quantity."""
+        record = self._require(name, size)
+        record.quantity += quantity
+        # Set availability to 1 if quantity is greater than 0
+        if record.quantity > 0:
+            record.available = True
+        self._notify("set", record)
+        return record.quantity
+
+    def sell_copies(self, name, size, quantity):
+        """Remove sold copies from an item and return its new quantity."""
+        record = self._require(name, size)
+        if quantity > record.quantity:
+            raise StockError("Not enough copies available for this transaction.")
+        new_quantity = record.quantity - quantity
+        record.quantity = new_quantity
+        # Set availability to 0 if quantity reaches 0
+        if new_quantity <= 0:
+            record.quantity = 0
+            record.available = False
+        self._notify("set", record)
+        return new_quantity
+
+    def apply_batch(self, operations):
+        """Apply (name, size, operation, quantity) changes, where operation is "add" or "sell".
+
+        Either every operation is applied or, if any item is missing or any sale would take an
+        item below zero, none are and StockError is raised. Returns the records that changed.
+        """
+        pending = {}  # (name, size) -> [quantity, available] after the operations so far
+        for number, (name, size, operation, quantity) in enumerate(operations, start=1):
+            record = self._by_key.get((name, size))
+            if record is None:
+                raise StockError(f"Operation {number}: item '{name}' ({size}) not found.")
+            state = pending.setdefault((name, size), [record.quantity, record.available])
+            if operation == "add":
+                state[0] += quantity
+                if state[0] > 0:
+                    state[1] = True
+            elif operation == "sell":
+                if quantity > state[0]:
+                    raise StockError(f"Operation {number}: not enough copies of '{name}' ({size}) "
+                                     f"to sell {quantity}, only {state[0]} left.")
+                state[0] -= quantity
+                if state[0] <= 0:
+                    state[1] = False
+            else:
+                raise StockError(f"Operation {number}: unknown operation '{operation}'.")
+
+        changed = []
+        for key, (quantity, available) in pending.items():
+            record = self._by_key[key]
+            record.quantity = quantity
+            record.available = available
+            changed.append(record)
+        for record in changed:
+            self._notify("set", record)
+        return changed
+
+    def remove_item(self, name, size):
+        """Remove an item size from the stock and return its record."""
+        record = self._require(name, size)
+        self._remove(record)
+        self._notify("remove", record)
+        return record
+
+    def restore(self, name, size, state):
+        """Put an item size back to a copy of an earlier record, or remove it if state is None."""
+        if state is None:
+            if self.exists(name, size):
+                self.remove_item(name, size)
+            return None
+        record = self._by_key.get((name, size))
+        if record is None:
+            record = state.copy()
+            self._insert(record)
+        else:
+            record.quantity = state.quantity
+            record.price_cents = state.price_cents
+            record.available = state.available
+        self._notify("set", record)
+        return record
+
+    def set_price(self, name, size, price):
+        """Set the price of an item."""
+        record = self._require(name, size)
+        record.price_cents = to_cents(price)
+        self._notify("set", record)
+        return record
@@ -0,0 +1,641 @@
+import atexit
+import csv
+import io
+import os
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from stock_store import FIELDNAMES, StockRecord, StockStore, to_cents
+
+# Advisory file locks: fcntl on Linux and macOS, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Number of journal records written before the CSV snapshot is rewritten
+COMPACT_EVERY = 1000
+
+# Change feed entries kept in the SQLite database when it is compacted; a process that has fallen
+# further behind than this reloads the whole table
+CHANGES_KEPT = 10000
+
+# Windows refuses to replace a file while another process has it open: attempts made, and seconds between them
+REPLACE_ATTEMPTS = 20
+REPLACE_RETRY_DELAY = 0.05
+
+
+# Helper function for reading a CSV stock snapshot
+def read_snapshot(filename):
+    with open(filename, mode='r', newline='') as file:
+        return [StockRecord.from_csv(row) for row in csv.DictReader(file)]
+
+
+# Helper function for streaming snapshot records from an open CSV file
+def iter_snapshot(file):
+    with file:
+        for row in csv.DictReader(file):
+            yield StockRecord.from_csv(row)
+
+
+# Helper function for replacing a file, retrying briefly while another process on Windows has it open
+def replace_file(source, destination):
+    for attempt in range(REPLACE_ATTEMPTS):
+        try:
+            os.replace(source, destination)
+            return
+        except PermissionError:
+            if os.name == 'posix' or attempt == REPLACE_ATTEMPTS - 1:
+                raise
+            time.sleep(REPLACE_RETRY_DELAY)
+
+
+# Helper function for flushing a directory entry change, such as a rename, to disk
+def fsync_directory(directory):
+    if os.name != 'posix':
+        return  # Windows has no way to open a directory for fsync; NTFS journals renames itself
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+@contextmanager
+def atomic_write(filename, newline=''):
+    """Write a text file through a temporary file that replaces it only once it is safely on disk.
+
+    A crash part way through leaves the old file untouched, and other processes only ever see the
+    old file or the complete new one. On Windows the replace fails with PermissionError if another
+    program keeps the file open for longer than the retries allow, for example a spreadsheet.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    descriptor, temp_path = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=directory)
+    try:
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(filename).st_mode))
+        except FileNotFoundError:
+            pass
+        with os.fdopen(descriptor, mode='w', newline=newline) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        replace_file(temp_path, filename)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_directory(directory)
+
+
+# Helper function for writing a CSV stock snapshot
+def write_snapshot(filename, stock_items):
+    with atomic_write(filename) as file:
+        writer = csv.writer(file)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(record.csv_values() for record in stock_items)
+
+
+def file_signature(path):
+    """Return (mtime, size) for a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def journal_path(filename):
+    """Return the journal file that belongs to a stock snapshot."""
+    return os.path.splitext(filename)[0] + ".journal"
+
+
+def lock_path(filename):
+    """Return the lock file that every process using a stock file locks before changing it."""
+    return os.path.splitext(filename)[0] + ".lock"
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, shared by every process and thread using it; re-entrant."""
+
+    def __init__(self, path):
+        """Initialize the lock; the file is created on first use."""
+        self.path = path
+        self.file = None
+        self.depth = 0
+        self._thread_lock = threading.RLock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self.file = open(self.path, mode='a+b')
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self.file.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass  # LK_LOCK gives up after ten seconds; keep waiting
+            except BaseException:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self._thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # Closing the file releases the lock
+            if fcntl is None:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self._thread_lock.release()
+
+
+class GroupCommit:
+    """Flushes a file to disk at most once per interval, from a background thread, however often it is written.
+
+    Writes stay visible to other processes straight away; only the wait for the disk is shared, so a
+    crash loses at most the last interval of changes.
+    """
+
+    def __init__(self, path, interval_ms):
+        """Initialize the group commit for a file."""
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def written(self):
+        """Note a write; the file is flushed when the current interval ends."""
+        with self._lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Flush the file to disk now if it has been written since the last flush."""
+        with self._lock:
+            if self.timer is None:
+                return
+            self.timer.cancel()
+            self.timer = None
+        try:
+            with open(self.path, mode='ab') as file:
+                os.fsync(file.fileno())
+        except FileNotFoundError:
+            pass
+
+
+class StockJournal:
+    """Append-only log of stock changes, replayed on top of the last CSV snapshot.
+
+    Several processes append to the same journal. offset is how far this process has read it, so
+    catching up only reads the records appended since. Each time the journal is emptied into the
+    snapshot it starts again with a header line holding the next generation number; generation is the
+    one this process has read, so it can tell when the journal it was reading has been replaced.
+    """
+
+    def __init__(self, filename, group_commit_ms=None):
+        """Initialize the journal; each append is flushed to disk unless group_commit_ms batches them."""
+        self.filename = filename
+        self.path = journal_path(filename)
+        self.offset = 0
+        self.generation = None
+        self.pending = 0
+        self.group_commit = None if group_commit_ms is None else GroupCommit(self.path, group_commit_ms)
+
+    def records(self, start=0):
+        """Yield (op, record) for every complete journal record from a byte offset, oldest first.
+
+        offset is moved past each record as it is read.
+        """
+        self.offset = start
+        try:
+            with open(self.path, mode='rb') as file:
+                file.seek(start)
+                offset = start
+                for line in file:
+                    if not line.endswith(b'\n'):
+                        break  # Torn or still being written
+                    offset += len(line)
+                    record = next(csv.reader([line.decode('utf-8')]))
+                    if len(record) == len(FIELDNAMES) + 1:
+                        yield record[0], StockRecord.from_csv(dict(zip(FIELDNAMES, record[1:])))
+                    self.offset = offset
+        except FileNotFoundError:
+            self.offset = 0
+
+    def replay(self, store, start=0, notify=False):
+        """Apply the journal records from a byte offset to the store and return how many were applied."""
+        count = 0
+        for op, record in self.records(start):
+            store.apply(op, record, notify=notify)
+            count += 1
+        return count
+
+    def read_generation(self):
+        """Return the generation of the journal on disk; 0 for a journal without a header, or none at all."""
+        try:
+            with open(self.path, mode='rb') as file:
+                header = file.readline()
+        except FileNotFoundError:
+            return 0
+        if header.startswith(b"generation,") and header.endswith(b"\n"):
+            return int(header[len(b"generation,"):])
+        return 0
+
+    def size(self):
+        """Return the size of the journal file in bytes."""
+        signature = file_signature(self.path)
+        return 0 if signature is None else signature[1]
+
+    def append_many(self, op, records):
+        """Append one change record per stock record in a single write."""
+        text = io.StringIO()
+        csv.writer(text).writerows([op] + record.csv_values() for record in records)
+        data = text.getvalue().encode('utf-8')
+        with open(self.path, mode='a+b') as file:
+            start = file.seek(0, os.SEEK_END)
+            if start:
+                file.seek(start - 1)
+                if file.read(1) != b'\n':
+                    # Close off a record torn by a crash, so it is skipped instead of swallowing this one
+                    data = b'\n' + data
+            file.write(data)
+            if start == self.offset:
+                # Nothing from other processes in between, so there is nothing new to read up to here
+                self.offset = start + len(data)
+            if self.group_commit is None:
+                file.flush()
+                os.fsync(file.fileno())
+        if self.group_commit is not None:
+            self.group_commit.written()
+        self.pending += len(records)
+
+    def clear(self):
+        """Empty the journal once its records are in the snapshot, starting its next generation."""
+        generation = self.read_generation() + 1
+        header = f"generation,{generation}\n"
+        # Replaced in one step, so no process ever sees an emptied journal without its new generation
+        with atomic_write(self.path) as file:
+            file.write(header)
+        self.generation = generation
+        self.offset = len(header)
+        self.pending = 0
+
+
+class CsvStorage:
+    """Stock kept in a CSV snapshot, with changes journaled or rewritten in full.
+
+    Processes sharing the files take the lock file for every change and first read what the others
+    have journaled since they last looked, so each change is made on the latest rows and only the
+    rows that changed are written. A new journal generation means another process has rewritten the
+    snapshot, and every row is compared instead.
+    """
+
+    def __init__(self, filename, journal_mode=True, compact_every=COMPACT_EVERY, group_commit_ms=None):
+        """Initialize the storage for the given CSV file.
+
+        Every write is on disk before it returns, unless group_commit_ms is set: then journal appends
+        are flushed to disk together once per that many milliseconds. Snapshot rewrites are always
+        flushed, since other tills read the snapshot.
+        """
+        self.filename = filename
+        self.journal_mode = journal_mode
+        self.compact_every = compact_every
+        self.journal = StockJournal(filename, group_commit_ms)
+        self.lock = FileLock(lock_path(filename))
+        self.store = None
+
+    def read_rows(self):
+        """Read the snapshot rows. The journal is replayed when a store is attached."""
+        with self.lock:
+            # The journal that goes with this snapshot, to be read from its start
+            self.journal.generation = self.journal.read_generation()
+            self.journal.offset = 0
+            return read_snapshot(self.filename)
+
+    def _write_snapshot(self, stock_items):
+        """Rewrite the snapshot and empty the journal; the caller holds the lock."""
+        write_snapshot(self.filename, stock_items)
+        # Records are full row states, so replaying them again after a crash here is harmless
+        self.journal.clear()
+
+    def write_rows(self, stock_items):
+        """Replace the stored stock with the given rows."""
+        with self.lock:
+            self._write_snapshot(StockStore(stock_items))
+
+    def load(self):
+        """Return the current stock, journal included, without recording further changes.
+
+        Without an attached store, a transaction on the returned store then only reads what other
+        processes journal after this.
+        """
+        with self.lock:
+            # A journal of its own: the attached store has not caught up with this snapshot
+            journal = StockJournal(self.filename)
+            journal.generation = journal.read_generation()
+            store = StockStore(read_snapshot(self.filename))
+            journal.replay(store)
+            if self.store is None:
+                self.journal.generation, self.journal.offset = journal.generation, journal.offset
+        return store
+
+    def attach(self, store):
+        """Replay pending changes into the store and persist its future changes."""
+        with self.lock:
+            if self.journal.read_generation() == self.journal.generation:
+                self.journal.pending = self.journal.replay(store, start=self.journal.offset)
+            else:
+                # Not read by read_rows(), or another process rewrote the snapshot since
+                self.sync(store)
+        self.store = store
+        store.set_transaction(lambda: self.transaction(store))
+        store.subscribe(self.save_row)
+        return store
+
+    def sync(self, store):
+        """Merge into the store the changes other processes have saved since it was last brought up to date."""
+        with self.lock:
+            if self.journal.read_generation() != self.journal.generation:
+                # Another process rewrote the snapshot, so compare every row
+                latest = StockStore(self.read_rows())
+                self.journal.replay(latest)
+                store.replace_all(latest)
+            else:
+                self.journal.replay(store, start=self.journal.offset, notify=True)
+
+    @contextmanager
+    def transaction(self, store):
+        """Hold the lock with the store up to date, so a change made inside is based on the latest rows."""
+        with self.lock:
+            self.sync(store)
+            yield store
+
+    def save_row(self, op, record):
+        """Persist one change made to the attached store."""
+        with self.lock:
+            if not self.journal_mode:
+                self._write_snapshot(self.store)
+                return
+            self.journal.append_many(op, [record])
+            if self.journal.pending >= self.compact_every:
+                self.compact()
+
+    def signature(self):
+        """Return a value that changes whenever the snapshot or the journal changes on disk."""
+        return file_signature(self.filename), file_signature(self.journal.path)
+
+    def save_changes(self, store, records):
+        """Persist changed records of a store that is not attached, in one write.
+
+        Called inside transaction(store), so the store is up to date: once compact_every records would
+        have been journaled, it is written out as the new snapshot instead.
+        """
+        with self.lock:
+            if self.journal_mode and self.journal.pending + len(records) < self.compact_every:
+                self.journal.append_many("set", records)
+            else:
+                self._write_snapshot(store)
+
+    def iter_rows(self, available_only=False):
+        """Stream the stock without loading it all; only the journal is held in memory.
+
+        The snapshot and journal are opened under the lock straight away, so a missing file raises
+        FileNotFoundError here rather than on the first row. On Windows an open snapshot could not be
+        replaced by other tills, so there the snapshot is read into memory instead of as rows are read.
+        """
+        with self.lock:
+            # Latest journaled state of each changed item; None for items removed since the snapshot
+            changes = {}
+            for op, record in StockJournal(self.filename).records():
+                changes[(record.name, record.size)] = record if op == "set" else None
+            snapshot_records = iter_snapshot(open(self.filename, mode='r', newline=''))
+            if os.name != 'posix':
+                snapshot_records = list(snapshot_records)
+        return self._stream(snapshot_records, changes, available_only)
+
+    @staticmethod
+    def _stream(snapshot_records, changes, available_only):
+        # Journaled records replace their snapshot row; the ones left over are items added since the snapshot
+        for record in snapshot_records:
+            record = changes.pop((record.name, record.size), record)
+            if record is not None and (not available_only or record.available):
+                yield record
+        for record in changes.values():
+            if record is not None and (not available_only or record.available):
+                yield record
+
+    def compact(self):
+        """Fold the journal back into the snapshot, including what other processes have journaled."""
+        with self.lock:
+            if self.journal.size() == 0:
+                return  # No journal, or an empty one: nothing to fold in
+            store = self.store
+            if store is None:
+                store = self.load()
+            else:
+                self.sync(store)
+            self._write_snapshot(store)
+
+
+class SqliteStorage:
+    """Stock kept in a SQLite table keyed by (name, size), updated one row at a time.
+
+    Every write also adds the changed (name, size) to a change feed, so a process catches up by
+    re-reading only the rows changed since its last look.
+    """
+
+    def __init__(self, filename):
+        """Open the database and create the stock table if needed."""
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.last_change = 0
+        self.depth = 0
+        self._thread_lock = threading.RLock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stock ("
+                "name TEXT NOT NULL, size TEXT NOT NULL, quantity INTEGER NOT NULL, "
+                "price REAL NOT NULL, availability INTEGER NOT NULL, PRIMARY KEY (name, size))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS stock_name ON stock (name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS stock_availability ON stock (availability)")
+            # A NULL name means the whole table was replaced
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stock_changes ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, size TEXT)")
+
+    def _log_changes(self, keys):
+        self.connection.executemany("INSERT INTO stock_changes (name, size) VALUES (?, ?)", keys)
+        if self.depth:
+            # Inside a transaction nobody else can write, so these are the newest changes
+            self.last_change = self._latest_change()
+
+    def _latest_change(self):
+        return self.connection.execute("SELECT coalesce(max(seq), 0) FROM stock_changes").fetchone()[0]
+
+    def _upsert(self, records):
+        records = list(records)
+        self.connection.executemany(
+            "INSERT INTO stock (name, quantity, price, size, availability) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (name, size) DO UPDATE SET quantity = excluded.quantity, price = excluded.price, "
+            "availability = excluded.availability",
+            ((record.name, record.quantity, record.price, record.size, int(record.available))
+             for record in records))
+        self._log_changes((record.name, record.size) for record in records)
+
+    @contextmanager
+    def _writing(self):
+        """Commit the writes made inside, unless they are part of a transaction that commits them later."""
+        with self._thread_lock:
+            if self.depth:
+                yield
+            else:
+                with self.connection:
+                    yield
+
+    def read_rows(self):
+        """Read every stock row."""
+        return list(self.iter_rows())
+
+    def write_rows(self, stock_items):
+        """Replace the stored stock with the given rows."""
+        with self._writing():
+            self.connection.execute("DELETE FROM stock")
+            self._upsert(StockStore(stock_items))
+            self._log_changes([(None, None)])
+
+    def load(self):
+        """Return the current stock without recording further changes."""
+        return StockStore(self.read_rows())
+
+    def attach(self, store):
+        """Persist every change made to the store as a single-row write."""
+        store.set_transaction(lambda: self.transaction(store))
+        store.subscribe(self.save_row)
+        return store
+
+    def sync(self, store):
+        """Merge into the store the rows other processes have changed since it was last brought up to date."""
+        with self._thread_lock:
+            changes = self.connection.execute(
+                "SELECT seq, name, size FROM stock_changes WHERE seq > ? ORDER BY seq", (self.last_change,)).fetchall()
+            if not changes:
+                return
+            first = self.connection.execute("SELECT min(seq) FROM stock_changes").fetchone()[0]
+            if first > self.last_change + 1 or any(name is None for seq, name, size in changes):
+                # Fell behind the kept change feed, or the whole table was replaced
+                store.replace_all(self.read_rows())
+                return
+            for key in dict.fromkeys((name, size) for seq, name, size in changes):
+                row = self.connection.execute(
+                    "SELECT name, quantity, price, size, availability FROM stock WHERE name = ? AND size = ?",
+                    key).fetchone()
+                if row is None:
+                    store.apply("remove", StockRecord(key[0], key[1], 0, 0, False), notify=True)
+                else:
+                    name, quantity, price, size, availability = row
+                    store.apply("set", StockRecord(name, size, quantity, to_cents(price), bool(availability)),
+                                notify=True)
+            self.last_change = changes[-1][0]
+
+    @contextmanager
+    def transaction(self, store):
+        """Hold the database write lock with the store up to date; the changes made inside commit together."""
+        with self._thread_lock:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield store
+                finally:
+                    self.depth -= 1
+                return
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.depth = 1
+            try:
+                self.sync(store)
+                yield store
+            except BaseException:
+                self.connection.rollback()
+                raise
+            else:
+                self.connection.commit()
+            finally:
+                self.depth = 0
+
+    def save_changes(self, store, records):
+        """Persist changed records of a store that is not attached, in one transaction."""
+        with self._writing():
+            self._upsert(records)
+
+    def save_row(self, op, record):
+        """Write one changed or removed record."""
+        with self._writing():
+            if op == "remove":
+                self.connection.execute("DELETE FROM stock WHERE name = ? AND size = ?", (record.name, record.size))
+                self._log_changes([(record.name, record.size)])
+            else:
+                self._upsert([record])
+
+    def signature(self):
+        """Return a value that changes whenever the database file changes on disk."""
+        return file_signature(self.filename)
+
+    def iter_rows(self, available_only=False):
+        """Stream the stock row by row from the database."""
+        # Rows changed after this point are picked up again by the next sync, which is harmless
+        self.last_change = max(self.last_change, self._latest_change())
+        where = "WHERE availability = 1" if available_only else ""
+        cursor = self.connection.execute(f"SELECT name, quantity, price, size, availability FROM stock {where}")
+        return (StockRecord(name, size, quantity, to_cents(price), bool(availability))
+                for name, quantity, price, size, availability in cursor)
+
+    def import_csv(self, csv_filename):
+        """Load a CSV snapshot and its journal into the database and return the number of rows imported."""
+        store = CsvStorage(csv_filename).load()
+        with self._writing():
+            self._upsert(store)
+            self._log_changes([(None, None)])
+        return len(store)
+
+    def compact(self):
+        """Trim the change feed and close the database; SQLite writes are already durable."""
+        with self.connection:
+            self.connection.execute("DELETE FROM stock_changes WHERE seq <= ?", (self._latest_change() - CHANGES_KEPT,))
+        self.connection.close()
+
+
+def open_storage(backend, filename, database_filename, journal_mode=True, group_commit_ms=None):
+    """Open the "csv" backend on filename or the "sqlite" backend on database_filename."""
+    if backend == "sqlite":
+        return SqliteStorage(database_filename)
+    return CsvStorage(filename, journal_mode=journal_mode, group_commit_ms=group_commit_ms)
+
+
+if __name__ == "__main__":
+    # One-shot import: python storage.py stock.csv stock.db
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python storage.py <stock.csv> <stock.db>")
+    imported = SqliteStorage(sys.argv[2]).import_csv(sys.argv[1])
+    print(f"Imported {imported} stock rows from '{sys.argv[1]}' into '{sys.argv[2]}'.")
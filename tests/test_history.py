@@ -0,0 +1,30 @@
+from history import StockHistory
+
+CHANGES = [
+    (1700000000.0, "Shirt", "M", 10, 999, None),
+    (1700000060.0, "Shirt", "M", 7, None, None),
+    (1700000120.0, "Hat", "L", 3, 500, 3),
+    (1700090000.0, "Shirt", "M", 12, 1099, 5),
+    (1700090060.0, "Shirt", "M", None, 1199, 0),
+]
+
+
+def contents(history):
+    return [history.connection.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3, 4").fetchall()
+            for table in ("events", "current", "rollups")]
+
+
+def test_record_many_matches_recording_one_change_at_a_time(tmp_path):
+    together = StockHistory(str(tmp_path / "together.db"))
+    together.record_many(CHANGES)
+    one_by_one = StockHistory(str(tmp_path / "one_by_one.db"))
+    for change in CHANGES:
+        one_by_one.record_many([change])
+    assert contents(together) == contents(one_by_one)
+
+
+def test_rollups_count_units_added_and_sold(tmp_path):
+    history = StockHistory(str(tmp_path / "history.db"))
+    history.record_many(CHANGES)
+    bucket, quantity, price_cents, units_added, units_sold, changes = history.rollups("Shirt", "M", "week")[0]
+    assert (quantity, price_cents, units_added, units_sold, changes) == (12, 1199, 15, 3, 4)
@@ -0,0 +1,236 @@
+import multiprocessing
+
+import pytest
+
+import storage
+from commands import AddCopies, CommandHistory
+from stock_store import StockError, StockRecord, StockStore
+from storage import CsvStorage, SqliteStorage
+
+HEADER = "name,quantity,price,size,availability\n"
+
+TILLS = 4
+OPERATIONS_PER_TILL = 300
+STARTING_QUANTITY = 100
+
+
+def open_backend(backend, path, compact_every=storage.COMPACT_EVERY):
+    if backend == "sqlite":
+        return SqliteStorage(path)
+    return CsvStorage(path, compact_every=compact_every)
+
+
+def attached_store(backend, path, compact_every=storage.COMPACT_EVERY):
+    stock = open_backend(backend, path, compact_every)
+    return stock, stock.attach(StockStore(stock.read_rows()))
+
+
+def create_stock(backend, path, records):
+    if backend == "sqlite":
+        SqliteStorage(path).write_rows(records)
+    else:
+        with open(path, mode='w', newline='') as file:
+            file.write(HEADER)
+        CsvStorage(path).write_rows(records)
+
+
+def run_till(backend, path):
+    """Alternately restock 2 and sell 1 copy, each change in its own transaction."""
+    # A small compact_every makes the tills rewrite the snapshot under each other many times
+    stock, store = attached_store(backend, path, compact_every=50)
+    for number in range(OPERATIONS_PER_TILL):
+        with store.transaction():
+            if number % 2:
+                store.sell_copies("Shirt", "M", 1)
+            else:
+                store.add_copies("Shirt", "M", 2)
+
+
+@pytest.fixture(params=["csv", "sqlite"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def stock_path(tmp_path, backend):
+    return str(tmp_path / ("stock.db" if backend == "sqlite" else "stock.csv"))
+
+
+def test_tills_in_separate_processes_lose_no_changes(backend, stock_path):
+    create_stock(backend, stock_path, [StockRecord("Shirt", "M", STARTING_QUANTITY, 999, True)])
+    tills = [multiprocessing.Process(target=run_till, args=(backend, stock_path)) for _ in range(TILLS)]
+    for till in tills:
+        till.start()
+    for till in tills:
+        till.join(timeout=120)
+        assert till.exitcode == 0
+
+    expected = STARTING_QUANTITY + TILLS * (OPERATIONS_PER_TILL // 2) * (2 - 1)
+    assert open_backend(backend, stock_path).load().get("Shirt", "M").quantity == expected
+
+
+def test_sync_merges_changes_from_another_till(backend, stock_path):
+    create_stock(backend, stock_path, [StockRecord("Shirt", "M", 5, 999, True),
+                                       StockRecord("Hat", "L", 2, 500, True)])
+    first, first_store = attached_store(backend, stock_path)
+    second, second_store = attached_store(backend, stock_path)
+    merged = []
+    first_store.subscribe(lambda op, record: merged.append((op, record.name)), remote=True)
+
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 3)
+        second_store.add_item("Scarf", "S", 4, 12.5)
+        second_store.remove_item("Hat", "L")
+
+    first.sync(first_store)
+    assert first_store.get("Shirt", "M").quantity == 2
+    assert first_store.get("Scarf", "S").price_cents == 1250
+    assert not first_store.exists("Hat", "L")
+    assert ("remove", "Hat") in merged
+
+
+def test_journal_replay_after_another_till_compacts(tmp_path):
+    stock_path = str(tmp_path / "stock.csv")
+    create_stock("csv", stock_path, [StockRecord("Shirt", "M", 10, 999, True)])
+    first, first_store = attached_store("csv", stock_path)
+    second, second_store = attached_store("csv", stock_path)
+
+    with first_store.transaction():
+        first_store.sell_copies("Shirt", "M", 1)
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 2)
+    # The snapshot is rewritten and the journal emptied, then written again from the start
+    second.compact()
+    with second_store.transaction():
+        second_store.add_item("Hat", "L", 3, 5)
+
+    with first_store.transaction():
+        first_store.sell_copies("Shirt", "M", 1)
+    assert first_store.get("Shirt", "M").quantity == 6
+    assert first_store.get("Hat", "L").quantity == 3
+
+    # A fresh load replays the journal on top of the compacted snapshot
+    latest = CsvStorage(stock_path).load()
+    assert latest.get("Shirt", "M").quantity == 6
+    assert latest.get("Hat", "L").quantity == 3
+
+
+def test_sync_reads_a_regrown_journal_after_another_till_compacts(tmp_path):
+    stock_path = str(tmp_path / "stock.csv")
+    create_stock("csv", stock_path, [StockRecord("Shirt", "M", 10, 999, True),
+                                     StockRecord("Shirt", "L", 10, 999, True)])
+    first, first_store = attached_store("csv", stock_path)
+    second, second_store = attached_store("csv", stock_path)
+
+    for _ in range(3):
+        with first_store.transaction():
+            first_store.sell_copies("Shirt", "M", 1)
+    # Compacted to an empty journal, which then grows back past where the first till had read to
+    second.compact()
+    with first_store.transaction():
+        first_store.sell_copies("Shirt", "M", 1)
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "L", 4)
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 2)
+    with first_store.transaction():
+        first_store.sell_copies("Shirt", "L", 1)
+
+    latest = CsvStorage(stock_path).load()
+    assert latest.get("Shirt", "M").quantity == 4
+    assert latest.get("Shirt", "L").quantity == 5
+
+
+def test_load_leaves_the_attached_store_to_catch_up(tmp_path):
+    stock_path = str(tmp_path / "stock.csv")
+    create_stock("csv", stock_path, [StockRecord("Shirt", "M", 10, 999, True)])
+    first, first_store = attached_store("csv", stock_path)
+    second, second_store = attached_store("csv", stock_path)
+
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 3)
+    assert first.load().get("Shirt", "M").quantity == 7
+    first.sync(first_store)
+    assert first_store.get("Shirt", "M").quantity == 7
+
+
+def test_transaction_after_load_reads_only_newer_records(tmp_path, monkeypatch):
+    stock_path = str(tmp_path / "stock.csv")
+    create_stock("csv", stock_path, [StockRecord("Shirt", "M", 10, 999, True)])
+    till, till_store = attached_store("csv", stock_path)
+    with till_store.transaction():
+        till_store.sell_copies("Shirt", "M", 1)
+
+    command_line = CsvStorage(stock_path, compact_every=1)
+    store = command_line.load()
+    with till_store.transaction():
+        till_store.sell_copies("Shirt", "M", 2)
+    monkeypatch.setattr(StockStore, "replace_all", None)  # A full reload would fail
+    with command_line.transaction(store):
+        store.add_copies("Shirt", "M", 5)
+        command_line.save_changes(store, [store.get("Shirt", "M")])
+    assert store.get("Shirt", "M").quantity == 12
+    # Saving would have journaled compact_every records, so the snapshot was rewritten instead
+    assert command_line.journal.size() == command_line.journal.offset
+    assert CsvStorage(stock_path).read_rows()[0].quantity == 12
+
+
+def test_journal_skips_a_torn_record(tmp_path):
+    stock_path = str(tmp_path / "stock.csv")
+    create_stock("csv", stock_path, [StockRecord("Shirt", "M", 10, 999, True)])
+    with open(storage.journal_path(stock_path), mode='ab') as file:
+        file.write(b"set,Shirt,1,9.99,M")  # Cut off by a crash before its newline
+    stock, store = attached_store("csv", stock_path)
+    with store.transaction():
+        store.sell_copies("Shirt", "M", 4)
+    assert CsvStorage(stock_path).load().get("Shirt", "M").quantity == 6
+
+
+def test_sqlite_change_feed_catch_up(tmp_path):
+    stock_path = str(tmp_path / "stock.db")
+    create_stock("sqlite", stock_path, [StockRecord("Shirt", "M", 5, 999, True)])
+    first, first_store = attached_store("sqlite", stock_path)
+    second, second_store = attached_store("sqlite", stock_path)
+
+    with second_store.transaction():
+        second_store.add_copies("Shirt", "M", 4)
+        second_store.add_item("Hat", "L", 1, 5)
+    first.sync(first_store)
+    assert first_store.get("Shirt", "M").quantity == 9
+    assert first_store.get("Hat", "L").quantity == 1
+    # Only the rows changed since are read again
+    assert first.last_change == first._latest_change()
+
+
+def test_sqlite_catch_up_after_the_change_feed_is_trimmed(tmp_path, monkeypatch):
+    stock_path = str(tmp_path / "stock.db")
+    create_stock("sqlite", stock_path, [StockRecord("Shirt", "M", 5, 999, True),
+                                        StockRecord("Hat", "L", 2, 500, True)])
+    first, first_store = attached_store("sqlite", stock_path)
+    second, second_store = attached_store("sqlite", stock_path)
+
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 5)
+        second_store.remove_item("Hat", "L")
+    monkeypatch.setattr(storage, "CHANGES_KEPT", 1)
+    SqliteStorage(stock_path).compact()
+
+    # The feed no longer reaches back to this till's last look, so the whole table is compared
+    first.sync(first_store)
+    assert first_store.get("Shirt", "M").quantity == 0
+    assert not first_store.exists("Hat", "L")
+
+
+def test_undo_refuses_a_row_another_till_has_changed(backend, stock_path):
+    create_stock(backend, stock_path, [StockRecord("Shirt", "M", 5, 999, True)])
+    first, first_store = attached_store(backend, stock_path)
+    second, second_store = attached_store(backend, stock_path)
+    history = CommandHistory(first_store)
+    history.execute(AddCopies("Shirt", "M", 3))
+
+    with second_store.transaction():
+        second_store.sell_copies("Shirt", "M", 1)
+
+    with pytest.raises(StockError):
+        history.undo()
+    assert open_backend(backend, stock_path).load().get("Shirt", "M").quantity == 7